@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+
+# benchmark of ElasticData operations on synthetic tree of files,
+# against local Elastic (--hosts) or in-process stand-in, which runs offline
+
+import argparse
+import contextlib
+import fnmatch
+import itertools
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from time import perf_counter
+from urllib.parse import urlparse, parse_qs, unquote
+
+from elasticDocs import ElasticData, Manifest, MAP, TYPE
+
+WORDS = ['alpha', 'bravo', 'charlie', 'delta', 'echo', 'foxtrot', 'golf', 'hotel', 'india', 'juliet', 'kilo',
+         'lima', 'mike', 'november', 'oscar', 'papa', 'quebec', 'romeo', 'sierra', 'tango', 'uniform', 'victor',
+         'whiskey', 'xray', 'yankee', 'zulu']
+
+
+# files - number of files, size - average file size (bytes), text_ratio - part of text files,
+# others are binary and skipped by indexing; returns (number of text files, their total size)
+def generate_tree(root, files=1000, size=4096, text_ratio=0.8, dirs=20, seed=1):
+    rnd = random.Random(seed)
+    text_files = 0
+    text_bytes = 0
+    for n in range(files):
+        directory = os.path.join(root, 'dir{}'.format(n % dirs), 'sub{}'.format(n % 3))
+        os.makedirs(directory, exist_ok=True)
+        file_size = max(1, int(rnd.expovariate(1.0 / size)))
+        if rnd.random() < text_ratio:
+            words = []
+            length = 0
+            while length < file_size:
+                word = rnd.choice(WORDS)
+                words.append(word)
+                length += len(word) + 1
+            data = ' '.join(words).encode()
+            name = 'file{}.txt'.format(n)
+            text_files += 1
+            text_bytes += len(data)
+        else:
+            data = bytes(rnd.getrandbits(8) for i in range(file_size))
+            name = 'file{}.bin'.format(n)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+    return text_files, text_bytes
+
+
+# latency of every request sent by Elastic client, by endpoint
+class RequestStats(object):
+
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def wrap(self, transport):
+        perform_request = transport.perform_request
+
+        def timed(method, url, *args, **kwargs):
+            start = perf_counter()
+            try:
+                return perform_request(method, url, *args, **kwargs)
+            finally:
+                with self.lock:
+                    self.latency[self.endpoint(method, url)].append(perf_counter() - start)
+
+        transport.perform_request = timed
+
+    @staticmethod
+    def endpoint(method, url):
+        parts = urlparse(url).path.strip('/').split('/')
+        return '{} {}'.format(method, next((part for part in reversed(parts) if part.startswith('_')), 'doc'))
+
+    def reset(self):
+        with self.lock:
+            latency, self.latency = self.latency, defaultdict(list)
+        return latency
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def report(name, seconds, files, size, latency):
+    all_latency = list(itertools.chain(*latency.values()))
+    print('{:<10} {:>8.2f}s {:>10.1f} files/s {:>8.2f} MB/s {:>7} requests'.format(
+        name, seconds, files / seconds, size / seconds / 1024 / 1024, len(all_latency)))
+    for endpoint, values in sorted(latency.items()):
+        print('    {:<24} {:>7} requests  p50 {:>8.2f}ms  p99 {:>8.2f}ms'.format(
+            endpoint, len(values), percentile(values, 50) * 1000, percentile(values, 99) * 1000))
+
+
+SHARDS = {'total': 1, 'successful': 1, 'skipped': 0, 'failed': 0}
+
+
+# in-memory stand-in for the part of Elastic API used by ElasticData, indices with aliases, no analysis:
+# match query is a word lookup, highlight is the first matching word
+class StandIn(object):
+
+    def __init__(self):
+        self.indices = {}
+        self.mappings = {}
+        self.settings = {}
+        self.aliases = {}
+        self.templates = {}
+        self.scrolls = {}
+        self.tasks = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+
+    def start(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self_, *args):
+                pass
+
+            def handle_request(self_):
+                url = urlparse(self_.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                length = int(self_.headers.get('Content-Length') or 0)
+                body = self_.rfile.read(length) if length else b''
+                with stand_in.lock:
+                    status, res = stand_in.handle(self_.command, [unquote(p) for p in url.path.split('/') if p],
+                                                  params, body)
+                data = json.dumps(res).encode() if res is not None else b''
+                self_.send_response(status)
+                self_.send_header('Content-Type', 'application/json')
+                self_.send_header('Content-Length', str(len(data)))
+                self_.end_headers()
+                if self_.command != 'HEAD':
+                    self_.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = handle_request
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return '127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+
+    def handle(self, method, path, params, body):
+        if not path:
+            return 200, {'version': {'number': '6.8.0'}, 'tagline': 'You Know, for Search'}
+        if path[0] == '_bulk' or path[-1] == '_bulk':
+            return 200, self.bulk(body)
+        if path[0] == '_cat':
+            rows = []
+            for index in self.resolve(path[-1]):
+                size = sum(len(json.dumps(doc)) for doc in self.indices.get(index, {}).values())
+                rows.append({'index': index, 'docs.count': str(len(self.indices.get(index, {}))),
+                             'store.size': str(size) if params.get('bytes') == 'b' else '{}b'.format(size)})
+            return 200, rows
+        if path[0] == '_search' and path[1] == 'scroll':
+            return self.scroll(method, json.loads(body or b'{}'))
+        if path[0] == '_tasks':
+            return 200, {'completed': True, 'response': self.tasks[path[1]]}
+        if path[0] == '_template':
+            if method == 'DELETE':
+                self.templates.pop(path[1], None)
+            else:
+                self.templates[path[1]] = json.loads(body)
+            return 200, {'acknowledged': True}
+        if path[0] == '_alias':
+            indices = self.aliases.get(path[1])
+            if not indices:
+                return 404, {}
+            return 200, {index: {'aliases': {path[1]: {}}} for index in indices}
+        if path[0] == '_reindex':
+            request = json.loads(body)
+            source = self.docs(request['source']['index'])
+            dest = self.create(request['dest']['index'])
+            for (index, doc_id), doc in source.items():
+                dest[doc_id] = doc
+            return 200, self.task({'created': len(source), 'updated': 0, 'deleted': 0, 'total': len(source),
+                                   'failures': []}, params)
+
+        name = path[0]
+        if len(path) == 1:
+            if method == 'HEAD':
+                return (200 if name in self.indices or name in self.aliases else 404), None
+            if method == 'PUT':
+                self.create(name, json.loads(body) if body else {})
+                return 200, {'acknowledged': True}
+            if method == 'DELETE':
+                for index in self.resolve(name):
+                    self.indices.pop(index, None)
+                    for indices in self.aliases.values():
+                        indices.discard(index)
+                return 200, {'acknowledged': True}
+        request = json.loads(body) if body else {}
+
+        endpoint = path[-1]
+        if endpoint == '_refresh':
+            return 200, {'acknowledged': True}
+        if '_settings' in path:
+            if method == 'PUT':
+                for index in self.resolve(name):
+                    self.settings.setdefault(index, {}).update(request.get('index', {}))
+                return 200, {'acknowledged': True}
+            return 200, {index: {'settings': {'index': dict(self.settings.get(index, {}))} if
+                                 self.settings.get(index) else {}} for index in self.resolve(name)}
+        if '_mapping' in path and method == 'PUT':
+            for index in self.resolve(name):
+                mapping = self.mappings.setdefault(index, {}).setdefault(TYPE, {})
+                mapping.setdefault('properties', {}).update(request.get('properties', {}))
+                if '_meta' in request:
+                    mapping['_meta'] = request['_meta']
+            return 200, {'acknowledged': True}
+        if endpoint == '_mapping':
+            return 200, {index: {'mappings': self.mappings.get(index, {})} for index in self.resolve(name)}
+        if endpoint == '_mget':
+            if 'ids' in request:
+                return 200, {'docs': [self.get(name, doc_id) for doc_id in request['ids']]}
+            return 200, {'docs': [self.get(doc['_index'], doc['_id']) for doc in request['docs']]}
+        docs = self.docs(name)
+        if endpoint == '_search':
+            return 200, self.search(docs, request, params)
+        if endpoint == '_count':
+            return 200, {'count': len(self.query(docs, request.get('query', {'match_all': {}})))}
+        if endpoint == '_delete_by_query':
+            deleted = self.query(docs, request['query'])
+            for (index, doc_id), doc in deleted:
+                del self.indices[index][doc_id]
+            return 200, self.task({'deleted': len(deleted), 'total': len(deleted), 'failures': []}, params)
+        if 'path.tree' in path:
+            return 200, {index: {'mappings': {TYPE: {'path.tree': {'full_name': 'path.tree'}}}}
+                         for index in self.resolve(name)}
+
+        # document API: /index/type/id
+        doc_id = path[-1]
+        if method == 'GET':
+            res = self.get(name, doc_id)
+            return (200 if res['found'] else 404), res
+        docs = self.create(name)
+        if method in ('PUT', 'POST'):
+            created = doc_id not in docs
+            docs[doc_id] = request
+            return (201 if created else 200), {'_id': doc_id, 'result': 'created' if created else 'updated'}
+        if method == 'DELETE':
+            found = docs.pop(doc_id, None) is not None
+            return (200 if found else 404), {'_id': doc_id, 'result': 'deleted' if found else 'not_found'}
+        return 400, {'error': 'not supported by stand-in'}
+
+    # indices of comma separated names of indices, aliases and wildcards
+    def resolve(self, name):
+        indices = set()
+        for part in name.split(','):
+            if part in self.aliases:
+                indices |= self.aliases[part]
+            elif '*' in part:
+                indices |= set(fnmatch.filter(self.indices, part))
+            else:
+                indices.add(part)
+        return sorted(indices)
+
+    # documents of index, created on first write with matching template
+    def create(self, index, body=None):
+        if index not in self.indices:
+            self.indices[index] = {}
+            body = body or {}
+            for template in self.templates.values():
+                if any(fnmatch.fnmatch(index, pattern) for pattern in template['index_patterns']):
+                    body = dict(template, **body)
+            self.mappings[index] = body.get('mappings', {})
+            for alias in body.get('aliases', {}):
+                self.aliases.setdefault(alias, set()).add(index)
+        return self.indices[index]
+
+    # (index, id) -> document of all indices of the name
+    def docs(self, name):
+        return {(index, doc_id): doc for index in self.resolve(name)
+                for doc_id, doc in self.indices.get(index, {}).items()}
+
+    def task(self, response, params):
+        if params.get('wait_for_completion') == 'false':
+            task = 'standin:{}'.format(next(self.counter))
+            self.tasks[task] = response
+            return {'task': task}
+        return response
+
+    def get(self, index, doc_id):
+        docs = self.indices.get(index, {})
+        if doc_id not in docs:
+            return {'_index': index, '_id': doc_id, 'found': False}
+        return {'_index': index, '_id': doc_id, 'found': True, '_source': docs[doc_id]}
+
+    def bulk(self, body):
+        lines = body.decode().splitlines()
+        items = []
+        while lines:
+            action = json.loads(lines.pop(0))
+            (op, meta), = action.items()
+            docs = self.create(meta['_index'])
+            if op == 'delete':
+                found = docs.pop(meta['_id'], None) is not None
+                items.append({op: {'_id': meta['_id'], 'status': 200 if found else 404}})
+            else:
+                doc_id = meta.get('_id') or str(next(self.counter))
+                status = 201 if doc_id not in docs else 200
+                docs[doc_id] = json.loads(lines.pop(0))
+                items.append({op: {'_id': doc_id, 'status': status}})
+        return {'took': 1, 'errors': any(item[op]['status'] >= 300 for item in items for op in item), 'items': items}
+
+    def search(self, docs, request, params):
+        query = request.get('query', {'match_all': {}})
+        hits = []
+        for (index, doc_id), doc, score in self.query(docs, query, scores=True):
+            source = doc
+            fields = request.get('_source', params.get('_source'))
+            if isinstance(fields, str):
+                fields = fields.split(',')
+            if isinstance(fields, list):
+                source = {k: v for k, v in doc.items() if k in fields}
+            hit = {'_index': index, '_id': doc_id, '_score': score, '_source': source}
+            words = self.match_words(query)
+            if 'highlight' in request and words:
+                content = doc.get('content', '').split()
+                hit['highlight'] = {'content': ['<em>{}</em>'.format(w) for w in content if w.lower() in words][:1]}
+            hits.append(hit)
+        hits.sort(key=lambda hit: -hit['_score'])
+
+        if 'scroll' in params:
+            size = int(params.get('size', request.get('size', 10)))
+            scroll_id = str(next(self.counter))
+            self.scrolls[scroll_id] = (hits[size:], size)
+            return {'_scroll_id': scroll_id, '_shards': SHARDS, 'hits': {'total': len(hits), 'hits': hits[:size]}}
+        start = request.get('from', 0)
+        size = request.get('size', 10)
+        return {'_shards': SHARDS, 'hits': {'total': len(hits), 'hits': hits[start:start + size]}}
+
+    def scroll(self, method, request):
+        if method == 'DELETE':
+            for scroll_id in request.get('scroll_id', []):
+                self.scrolls.pop(scroll_id, None)
+            return 200, {'succeeded': True}
+        scroll_id = request['scroll_id']
+        hits, size = self.scrolls[scroll_id]
+        self.scrolls[scroll_id] = (hits[size:], size)
+        return 200, {'_scroll_id': scroll_id, '_shards': SHARDS, 'hits': {'total': len(hits), 'hits': hits[:size]}}
+
+    # (id, doc) or (id, doc, score) of documents matching query
+    def query(self, docs, query, scores=False):
+        res = []
+        for doc_id, doc in docs.items():
+            score = self.score(query, doc)
+            if score:
+                res.append((doc_id, doc, score) if scores else (doc_id, doc))
+        return res
+
+    # 0 if document doesn't match query
+    def score(self, query, doc):
+        (kind, body), = query.items()
+        if kind == 'match_all':
+            return 1
+        if kind == 'bool':
+            required = self.as_list(body.get('must')) + self.as_list(body.get('filter'))
+            scores = [self.score(q, doc) for q in required]
+            if not all(scores) or any(self.score(q, doc) for q in self.as_list(body.get('must_not'))):
+                return 0
+            should = [self.score(q, doc) for q in self.as_list(body.get('should'))]
+            if should and not required and not any(should):
+                return 0
+            return sum(scores) + sum(should) or 1
+        if kind == 'match':
+            words = self.match_words(query)
+            return sum(1 for word in doc.get('content', '').lower().split() if word in words)
+        (field, value), = body.items()
+        if isinstance(value, dict):
+            value = value['value']
+        values = self.values(doc, field)
+        if kind == 'term':
+            return int(value in values)
+        if kind == 'terms':
+            return int(any(v in values for v in value))
+        if kind == 'prefix':
+            return int(any(str(v).startswith(value) for v in values))
+        if kind == 'exists':
+            return int(value in doc)
+        raise ValueError('query {} is not supported by stand-in'.format(kind))
+
+    def match_words(self, query):
+        if 'match' in query:
+            return set(list(query['match'].values())[0].lower().split())
+        if 'bool' in query:
+            return set().union(*[self.match_words(q) for q in self.as_list(query['bool'].get('must'))])
+        return set()
+
+    @staticmethod
+    def values(doc, field):
+        if field == 'path.tree':
+            path = doc.get('path', '')
+            return set(path[:i] for i in range(1, len(path) + 1) if i == len(path) or path[i] == '/')
+        return {doc[field]} if field in doc else set()
+
+    @staticmethod
+    def as_list(value):
+        if value is None:
+            return []
+        return value if isinstance(value, list) else [value]
+
+
+def run(name, stats, files, size, func):
+    stats.reset()
+    start = perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        func()
+    report(name, perf_counter() - start, files, size, stats.reset())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark of elasticDocs operations')
+    parser.add_argument("--hosts", dest="hosts", nargs='+',
+                        help="Elastic to benchmark against, in-process stand-in if not set")
+    parser.add_argument("--index", dest="index", default='elasticdocs-bench',
+                        help="index created and deleted by benchmark (default: %(default)s)")
+    parser.add_argument("--files", dest="files", type=int, default=2000,
+                        help="number of files in generated tree (default: %(default)s)")
+    parser.add_argument("--size", dest="size", type=int, default=4096,
+                        help="average file size, bytes (default: %(default)s)")
+    parser.add_argument("--text-ratio", dest="text_ratio", type=float, default=0.8,
+                        help="part of text files, others are binary (default: %(default)s)")
+    parser.add_argument("--queries", dest="queries", type=int, default=50,
+                        help="number of search queries (default: %(default)s)")
+    parser.add_argument("-b", "--bulk", dest="bulk", action="store_true", help="use bulk API")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="number of workers reading files (default: %(default)s)")
+    parser.add_argument("--dir", dest="dir", help="directory for generated tree, temporary if not set")
+    parser.add_argument("--partition-depth", dest="partition_depth", type=int, default=0,
+                        help="index to partitions named after first N directories of path (default: %(default)s)")
+    args = parser.parse_args()
+
+    stand_in = None
+    hosts = args.hosts
+    if not hosts:
+        stand_in = StandIn()
+        hosts = [stand_in.start()]
+
+    root = args.dir or tempfile.mkdtemp(prefix='elasticdocs-bench-')
+    tree = os.path.join(root, 'tree')
+    text_files, text_bytes = generate_tree(tree, files=args.files, size=args.size, text_ratio=args.text_ratio)
+    print('tree: {} files, {} text files, {:.1f} MB of text, Elastic: {}'.format(
+        args.files, text_files, text_bytes / 1024 / 1024, 'stand-in' if stand_in else ' '.join(hosts)))
+
+    manifest = Manifest(os.path.join(root, 'manifest.sqlite3'))
+    docs = ElasticData(elastic_hosts=hosts, index=args.index, type=TYPE, map=MAP, manifest=manifest,
+                       partition_depth=args.partition_depth)
+    stats = RequestStats()
+    stats.wrap(docs.es.transport)
+    try:
+        docs.es.indices.delete(index=[args.index, args.index + '-*'], ignore=404)
+        docs.es.indices.delete_template(name=args.index, ignore=404)
+        docs.connect()
+        if not docs.is_connected():
+            print('error: can\'t establish connection to Elastic')
+            sys.exit(1)
+        index_args = {'bulk': args.bulk, 'workers': args.jobs}
+
+        run('import', stats, text_files, text_bytes, lambda: docs.import_docs(paths=[tree], **index_args))
+        docs.es.indices.refresh(index=args.index)
+        # without manifest every file is read and compared with index
+        docs.manifest = None
+        run('update', stats, text_files, text_bytes, lambda: docs.update(**index_args))
+        docs.manifest = manifest
+        run('update-m', stats, text_files, text_bytes, lambda: docs.update(**index_args))
+
+        rnd = random.Random(1)
+        queries = [' '.join(rnd.sample(WORDS, 2)) for i in range(args.queries)]
+        run('search', stats, args.queries, 0, lambda: [list(docs.search(q)) for q in queries])
+
+        shutil.rmtree(os.path.join(tree, 'dir0'))
+        run('cleanup', stats, text_files, 0, lambda: docs.cleanup())
+    finally:
+        manifest.close()
+        docs.es.indices.delete(index=[args.index, args.index + '-*'], ignore=404)
+        docs.es.indices.delete_template(name=args.index, ignore=404)
+        if not args.dir:
+            shutil.rmtree(root)
+        if stand_in:
+            stand_in.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,85 @@
 #!/usr/bin/env python3
 
+import codecs
+import contextlib
+import errno
 import hashlib
 import logging
 import os
+import re
 import sys
-from time import sleep
+import atexit
+import sqlite3
+import threading
+from time import sleep, monotonic
 import datetime
 import argparse
+import asyncio
+import stat
+from collections import deque
+from itertools import islice
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import magic
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import scan
+from elasticsearch import Elasticsearch, ElasticsearchException
+from elasticsearch.helpers import scan, streaming_bulk, parallel_bulk
+try:
+    from elasticsearch import AsyncElasticsearch
+    from elasticsearch.helpers import async_scan, async_streaming_bulk
+except ImportError:
+    # --async needs elasticsearch[async] >= 7.8
+    AsyncElasticsearch = None
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    # --watch falls back to polling
+    INotify = None
 
 ELASTIC_HOSTS = ['127.0.0.1',]
 INDEX = 'mydata'
 TYPE = 'mydocs'
 
+# bulk API defaults
+BULK_CHUNK_SIZE = 500
+BULK_MAX_CHUNK_BYTES = 100 * 1024 * 1024
+
+# number of documents in one scroll page for cleanup
+SCROLL_SIZE = 5000
+
+# --async: max number of requests in flight
+CONCURRENCY = 8
+
+# files with these extensions are indexed as text without mime sniffing
+TEXT_EXTENSIONS = ['.txt', '.md', '.rst', '.csv', '.log', '.conf', '.cfg', '.ini', '.yml', '.yaml', '.json', '.xml',
+                   '.html', '.htm', '.py', '.sh', '.sql']
+# files with these extensions are never indexed
+SKIP_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.ico', '.svgz', '.iso', '.img', '.so', '.o', '.a',
+                   '.dll', '.exe', '.bin', '.pyc', '.class', '.jar', '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z',
+                   '.rar', '.tar', '.mp3', '.mp4', '.avi', '.mkv', '.mov', '.pdf', '.doc', '.docx', '.xls', '.xlsx',
+                   '.sqlite3', '.db']
+
+# files bigger than this are indexed as parts of this size, each part is a separate document
+SPLIT_SIZE = 16 * 1024 * 1024
+# part is extended to the end of line, but not longer than this
+PART_LINE_LIMIT = 64 * 1024
+
+# --watch: changes are indexed when there are no new events for DEBOUNCE seconds, but not later than MAX_DELAY
+# seconds after the first one; directories without inotify watch are polled every POLL_INTERVAL seconds
+DEBOUNCE = 2
+MAX_DELAY = 30
+POLL_INTERVAL = 60
+
+# --partition-depth: files are indexed to partitions per share, named after first directories of their path,
+# behind alias with INDEX name; files with fewer directories are indexed to this partition
+DEFAULT_PARTITION = 'default'
+
+# content hash, stored in the field with the same name: md5 or faster blake2b
+HASH = 'md5'
+HASHES = ['md5', 'blake2b']
+
+# local cache of already indexed files
+MANIFEST = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'elasticDocs.manifest.sqlite3')
+
 MAP = {
     "settings": {
     "analysis": {
@@ -49,6 +114,15 @@ MAP = {
             "en_stop",
             "en_stemmer"
           ]
+        },
+        "path_analyzer": {
+          "tokenizer": "path_tokenizer"
+        }
+      },
+      "tokenizer": {
+        "path_tokenizer": {
+          "type": "path_hierarchy",
+          "delimiter": "/"
         }
       }
     }
@@ -59,13 +133,36 @@ MAP = {
 
             "properties": {
                 "path": {
-                    "type": "keyword"
+                    "type": "keyword",
+                    "fields": {
+                        # /data/foo/bar.txt -> /data, /data/foo, /data/foo/bar.txt
+                        "tree": {
+                            "type": "text",
+                            "analyzer": "path_analyzer",
+                            "search_analyzer": "keyword"
+                        }
+                    }
                 },
                 "md5": {
                     "type": "keyword"
                 },
+                "blake2b": {
+                    "type": "keyword"
+                },
                 "mdate": {
                     "type": "date"
+                },
+                "size": {
+                    "type": "long"
+                },
+                "parts": {
+                    "type": "integer"
+                },
+                "part": {
+                    "type": "integer"
+                },
+                "offset": {
+                    "type": "long"
                 }
             }
         }
@@ -73,60 +170,349 @@ MAP = {
 }
 
 
+# document id derived from normalized path, so a file's document is addressed without search
+def doc_id(path):
+    return hashlib.sha1(os.path.normpath(path).encode('utf-8', errors='surrogateescape')).hexdigest()
+
+
+# partition index of files in the directory: index name with first depth directories, lowercased,
+# characters not allowed in index names replaced
+@lru_cache(maxsize=4096)
+def partition_name(index, directory, depth):
+    dirs = [name for name in directory.split('/') if name not in ('', '.')]
+    if len(dirs) < depth:
+        return '{}-{}'.format(index, DEFAULT_PARTITION)
+    return '{}-{}'.format(index, re.sub(r'[^a-z0-9_.-]', '_', '-'.join(dirs[:depth]).lower()))[:255]
+
+
+# part id of split file
+def part_id(path, part):
+    return '{}-{}'.format(doc_id(path), part)
+
+
+# yields (offset, data) parts of the file object
+def file_parts(f, split_size):
+    offset = 0
+    while True:
+        data = f.read(split_size)
+        if not data:
+            return
+        if not data.endswith(b'\n'):
+            data += f.readline(PART_LINE_LIMIT)
+        yield offset, data
+        offset += len(data)
+
+
+def new_hash(hash_name, data=b''):
+    if hash_name == 'blake2b':
+        # 128 bit digest, as long as md5
+        return hashlib.blake2b(data, digest_size=16)
+    return hashlib.new(hash_name, data)
+
+
+# runs in worker pool: mime sniffing, reading, decoding and hashing of the file,
+# returns document to index or None if file is not text;
+# file bigger than split_size is hashed by parts and its document has number of parts instead of content
+def read_doc(file, st, sniff=False, split_size=None, hash_name=HASH):
+    if sniff and not magic.from_file(file, mime=True).startswith('text/'):
+        return None
+
+    if split_size and st.st_size > split_size:
+        file_hash = new_hash(hash_name)
+        parts = 0
+        with open(file, 'rb') as f:
+            for offset, data in file_parts(f, split_size):
+                file_hash.update(data)
+                parts += 1
+        return {
+            'path': file,
+            hash_name: file_hash.hexdigest(),
+            'mdate': st.st_mtime,
+            'size': st.st_size,
+            'parts': parts
+        }
+
+    with open(file, 'rb') as f:
+        content = f.read()
+    return {
+        'path': file,
+        'content': content.decode('utf-8', errors='ignore'),
+        hash_name: new_hash(hash_name, content).hexdigest(),
+        'mdate': st.st_mtime,
+        'size': st.st_size
+    }
+
+
+# decides how file found in directory is indexed: None - skip it, True - index only if it's text,
+# False - index as text without sniffing; size - callable returning file size, called only if size is limited
+def file_filter(name, size, text_ext, skip_ext, min_size=1, max_size=None):
+    ext = os.path.splitext(name)[1].lower()
+    if ext in skip_ext:
+        return None
+    if min_size or max_size is not None:
+        file_size = size()
+        if file_size < min_size or (max_size is not None and file_size > max_size):
+            return None
+    return ext not in text_ext
+
+
+# mappings - get_mapping() response, index created by older version isn't rekeyed until --rekey is done
+def is_rekeyed(mappings, type):
+    return all(mapping['mappings'].get(type, {}).get('_meta', {}).get('rekeyed')
+               for mapping in mappings.values())
+
+
+# index -> refresh_interval from get_settings() response, None - default
+def refresh_intervals(settings):
+    return {index: value['settings'].get('index', {}).get('refresh_interval') for index, value in settings.items()}
+
+
+def batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+# names of files in directory, None if it can't be listed but may exist (no read permission, I/O error)
+def file_names(directory):
+    try:
+        with os.scandir(directory or '.') as entries:
+            return frozenset(entry.name for entry in entries if entry.is_file())
+    except OSError as e:
+        if e.errno in (errno.ENOENT, errno.ENOTDIR):
+            return frozenset()
+        return None
+
+
+# False only if the file is surely removed, errors other than missing path keep it in index
+def file_exists(path):
+    try:
+        return stat.S_ISREG(os.stat(path).st_mode)
+    except OSError as e:
+        return e.errno not in (errno.ENOENT, errno.ENOTDIR)
+
+
+# path -> (mtime, size, content hash) of files already indexed, lets unchanged files be skipped after os.stat,
+# also caches mime sniffing results by (device, inode, mtime, size)
+class Manifest(object):
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS files (path BLOB PRIMARY KEY, mtime REAL, size INTEGER, md5 TEXT)',
+        'CREATE TABLE IF NOT EXISTS mime (dev INTEGER, ino INTEGER, mtime REAL, size INTEGER, text INTEGER, '
+        'PRIMARY KEY (dev, ino))'
+    ]
+    COMMIT_EVERY = 1000
+
+    def __init__(self, path):
+        self.path = path
+        # used from bulk threads too, access is serialized with the lock
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        for query in self.SCHEMA:
+            self.conn.execute(query)
+        self.lock = threading.Lock()
+        self.changes = 0
+
+    def unchanged(self, file, st):
+        with self.lock:
+            row = self.conn.execute('SELECT mtime, size FROM files WHERE path = ?', (os.fsencode(file),)).fetchone()
+        return row is not None and row[0] == st.st_mtime and row[1] == st.st_size
+
+    def put(self, file, mtime, size, md5):
+        self.execute('INSERT OR REPLACE INTO files (path, mtime, size, md5) VALUES (?, ?, ?, ?)',
+                     (os.fsencode(file), mtime, size, md5))
+
+    # True/False if file is known to be text or not, None if file is not sniffed yet or changed since then
+    def is_text(self, st):
+        with self.lock:
+            row = self.conn.execute('SELECT mtime, size, text FROM mime WHERE dev = ? AND ino = ?',
+                                    (st.st_dev, st.st_ino)).fetchone()
+        if row is None or row[0] != st.st_mtime or row[1] != st.st_size:
+            return None
+        return bool(row[2])
+
+    def put_mime(self, st, text):
+        self.execute('INSERT OR REPLACE INTO mime (dev, ino, mtime, size, text) VALUES (?, ?, ?, ?, ?)',
+                     (st.st_dev, st.st_ino, st.st_mtime, st.st_size, int(text)))
+
+    def delete(self, file):
+        self.execute('DELETE FROM files WHERE path = ?', (os.fsencode(file),))
+
+    # delete path and everything under it
+    def delete_tree(self, path):
+        prefix = os.fsencode(path.rstrip('/') + '/')
+        self.execute('DELETE FROM files WHERE path = ? OR substr(path, 1, ?) = ?',
+                     (os.fsencode(path), len(prefix), prefix))
+
+    def clear(self):
+        self.execute('DELETE FROM files')
+
+    def execute(self, query, params=()):
+        with self.lock:
+            self.conn.execute(query, params)
+            self.changes += 1
+            if self.changes >= self.COMMIT_EVERY:
+                self.conn.commit()
+                self.changes = 0
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.changes = 0
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
 class ElasticData(object):
 
-    def __init__(self, elastic_hosts, index, type, map):
+    def __init__(self, elastic_hosts, index, type, map, manifest=None, split_size=SPLIT_SIZE, hash_name=HASH,
+                 partition_depth=0, shards=None, replicas=None):
         self.elastic_hosts = elastic_hosts
+        # index or alias of partitions
         self.index = index
+        self.partition_depth = partition_depth
+        self.shards = shards
+        self.replicas = replicas
         self.type = type
         self.map = map
+        self.manifest = manifest
+        self.split_size = split_size
+        self.hash_name = hash_name
+        # content hashes of documents in index, see known_hashes()
+        self.hashes = None
         self.connected = False
+        self.path_tree = None
+        # False - index has documents with auto-generated ids of older version, see rekey()
+        self.rekeyed = True
         self.es = Elasticsearch(self.elastic_hosts)
         self.info = {}
 
-    def connect(self):
+    # create=False - missing index isn't created, --migrate continues from the copy then
+    def connect(self, create=True):
         self.connected = self.es.ping()
         # create index if connection is ok
         if self.connected:
-            if not self.es.indices.exists(index=self.index):
-                self.es.indices.create(index=self.index, body=self.map)
+            if self.es.indices.exists_alias(name=self.index):
+                self.partitioned(self.es.indices.get_mapping(index=self.index))
+                self.es.indices.put_template(name=self.index, body=self.template())
+            elif self.es.indices.exists(index=self.index):
+                self.not_partitioned(self.es.indices.get_mapping(index=self.index))
+            elif create:
+                if self.partition_depth:
+                    self.es.indices.put_template(name=self.index, body=self.template())
+                    # the alias exists from the start
+                    self.es.indices.create(index=self.index_of(''), ignore=400)
+                else:
+                    self.es.indices.create(index=self.index, body=self.index_map())
+                # nothing is indexed in new index
+                if self.manifest:
+                    self.manifest.clear()
+
+    # depth of existing partitions is used, mappings - get_mapping() of the alias
+    def partitioned(self, mappings):
+        depth = max(mapping['mappings'].get(self.type, {}).get('_meta', {}).get('partition_depth', 0)
+                    for mapping in mappings.values())
+        if self.partition_depth and self.partition_depth != depth:
+            print('warning: {} is partitioned with depth {}'.format(self.index, depth))
+        self.partition_depth = depth
+        self.rekeyed = is_rekeyed(mappings, self.type)
+
+    def not_partitioned(self, mappings):
+        if self.partition_depth:
+            print('warning: {} is not partitioned, see --migrate'.format(self.index))
+        self.partition_depth = 0
+        self.rekeyed = is_rekeyed(mappings, self.type)
 
+    # index of the file's documents
+    def index_of(self, path):
+        if not self.partition_depth:
+            return self.index
+        return partition_name(self.index, os.path.dirname(os.path.normpath(path)), self.partition_depth)
+
+    # MAP with shards and replicas for new index, documents of new index have ids derived from path
+    def index_map(self):
+        settings = dict(self.map['settings'])
+        if self.shards:
+            settings['number_of_shards'] = self.shards
+        if self.replicas is not None:
+            settings['number_of_replicas'] = self.replicas
+        mapping = dict(self.map['mappings'][self.type], _meta=self.meta())
+        return dict(self.map, settings=settings, mappings={self.type: mapping})
+
+    # _meta of mapping, put_mapping() replaces it as a whole
+    def meta(self):
+        return {'partition_depth': self.partition_depth, 'rekeyed': True}
+
+    # partitions are created by Elastic on first write with this template, already behind the alias,
+    # partition depth is kept in mapping
+    def template(self):
+        return dict(self.index_map(), index_patterns=[self.index + '-*'], aliases={self.index: {}})
+
+    # docs count and store size (bytes) of all partitions
     def update_info(self, wait=1):
         sleep(wait)
-        self.info = self.es.cat.indices(index=self.index, format='json')[0]
+        indices = self.es.cat.indices(index=self.index, format='json', bytes='b')
+        self.info = {
+            'docs.count': sum(int(index['docs.count']) for index in indices),
+            'store.size': sum(int(index['store.size']) for index in indices)
+        }
         return self.info
 
     def is_connected(self):
         return self.connected
 
-    def search(self, q=None):
-        query = q
-        if q is None:
-            query = ' '.join(sys.argv[1:])
+    # yields hits with highlighted fragments of content, page of size hits starting from from_ or,
+    # for deep pagination, after search_after - 'sort' of the last hit of previous page;
+    # path - search only in files under the path, source - fields of hit's _source
+    def search(self, q, path=None, size=10, from_=0, search_after=None, fragment_size=150, number_of_fragments=3,
+               source=('path', 'part', 'offset'), track_total_hits=False):
+        body = self.search_body(q, path=path, size=size, from_=from_, search_after=search_after,
+                                fragment_size=fragment_size, number_of_fragments=number_of_fragments, source=source,
+                                track_total_hits=track_total_hits)
+        res = self.es.search(index=self.index, body=body)
+        for item in res['hits']['hits']:
+            yield item
 
+    def search_body(self, q, path=None, size=10, from_=0, search_after=None, fragment_size=150,
+                    number_of_fragments=3, source=('path', 'part', 'offset'), track_total_hits=False):
         body = {
-            "_source": ['path', ],
+            "_source": list(source),
             'query':
-                {'match':
-                     {'content': query
+                {'bool':
+                     {'must': {'match': {'content': q}},
+                      'filter': [self.path_query(path)] if path else []
                       }
                  },
             "highlight": {
                 "fields": {
-                    "content": {}
+                    "content": {
+                        "fragment_size": fragment_size,
+                        "number_of_fragments": number_of_fragments
+                    }
                 }
-            }
+            },
+            # path and part make order of hits with equal score stable for search_after
+            "sort": [
+                {"_score": "desc"},
+                {"path": "asc"},
+                {"part": {"order": "asc", "missing": "_first", "unmapped_type": "integer"}}
+            ],
+            "size": size,
+            "track_total_hits": track_total_hits
         }
+        if search_after:
+            body['search_after'] = search_after
+        else:
+            body['from'] = from_
+        return body
 
-        res = self.es.search(index=INDEX, body=body)
-
-        for item in res['hits']['hits']:
-            print(item['_score'], item['_source']['path'])
-            for hl in item['highlight']['content']:
-                print('<<<\n', hl, '\n>>>')
-            print('-' * 50)
-
-    def import_docs(self, paths=None):
+    def import_docs(self, paths=None, bulk=False, chunk_size=BULK_CHUNK_SIZE,
+                    max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1, workers=1, queue_depth=None, processes=False,
+                    text_ext=TEXT_EXTENSIONS, skip_ext=SKIP_EXTENSIONS, min_size=1, max_size=None):
 
         if paths is None:
             print('warning: nothing to index')
@@ -137,120 +523,399 @@ class ElasticData(object):
         if type(paths) is str:
             paths = [paths]
 
-        import_status = {
+        files = self.walk(paths, text_ext=text_ext, skip_ext=skip_ext, min_size=min_size, max_size=max_size)
+        import_status = self.index_files(files, skip=True, verbose=not bulk, bulk=bulk,
+                                         chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                         threads=threads, workers=workers, queue_depth=queue_depth,
+                                         processes=processes)
+
+        print('added: ', import_status['added'], ' updated: ', import_status['updated'], 'skipped: ',
+              import_status['skipped'], 'failed: ', import_status['failed'])
+
+    # files given explicitly and files from given directories, yields (file, sniff),
+    # sniff is True if file has to be indexed only when it's text;
+    # files in directories are filtered by extension and size (bytes) before sniffing
+    def walk(self, paths, text_ext=TEXT_EXTENSIONS, skip_ext=SKIP_EXTENSIONS, min_size=1, max_size=None):
+        text_ext = set(ext.lower() for ext in text_ext)
+        skip_ext = set(ext.lower() for ext in skip_ext)
+        for path in paths:
+            if os.path.isfile(path):
+                yield path, False
+                continue
+
+            dirs = [path]
+            while dirs:
+                try:
+                    entries = list(os.scandir(dirs.pop()))
+                except OSError:
+                    continue
+                for entry in entries:
+                    # d_type from directory listing, no stat needed
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    sniff = file_filter(entry.name, lambda: entry.stat().st_size, text_ext, skip_ext,
+                                        min_size=min_size, max_size=max_size)
+                    if sniff is not None:
+                        yield entry.path, sniff
+
+    def index_files(self, files, skip=True, verbose=False, bulk=False, chunk_size=BULK_CHUNK_SIZE,
+                    max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1, workers=1, queue_depth=None,
+                    processes=False):
+        status = {
             'skipped': 0,
             'added': 0,
             'updated': 0,
-            'not_found': 0
+            'not_found': 0,
+            'failed': 0
         }
+        docs = self.read(files, workers=workers, queue_depth=queue_depth, processes=processes)
 
-        for path in paths:
-            if os.path.isfile(path):
-                print(path)
-                ret = self.file2index(file=path)
-                import_status[ret] += 1
-            else:
-                for root, dirs, files in os.walk(path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        # print(file_path)
-                        if magic.from_file(file_path, mime=True).startswith('text/'):
-                            print(file_path)
-                            ret = self.file2index(file=file_path)
-                            import_status[ret] += 1
+        if not bulk:
+            for file, ret, doc in docs:
+                if ret is None and doc is None:
+                    # not text
+                    continue
+                if verbose:
+                    print(file)
+                if doc is not None:
+                    ret = self.file2index(file=file, skip=skip, doc=doc)
+                status[ret] += 1
+            return status
 
-        print('added: ', import_status['added'], ' updated: ', import_status['updated'], 'skipped: ',
-              import_status['skipped'])
+        # bulk API returns results in the same order as actions were sent,
+        # so status of every action waits in the queue for its result
+        pending = deque()
 
-    def file2index(self, file=None, skip=True):
-        if not file or not os.path.isfile(file):
-            return 'not_found'
+        def actions():
+            for batch in batches(docs, chunk_size):
+                existing = self.lookup([file for file, ret, doc in batch if doc is not None])
+                yield from self.batch_actions(batch, existing, skip, status, pending)
 
-        content = open(file, 'rb').read()
-        file_md5 = hashlib.md5(content).hexdigest()
-        if skip:
-            res = self.es.search(index=INDEX, body={'query': {'term': {'md5': file_md5}}})
-            if res['hits']['hits'] != []:
-                # content of file already in index, skip it
-                return 'skipped'
+        file_failed = False
+        for ok, item in self.bulk(actions(), chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                  threads=threads):
+            file_failed, incomplete = self.bulk_result(ok, item, pending, status, file_failed)
+            if incomplete:
+                self.es.delete(index=incomplete['_index'], doc_type=incomplete['_type'], id=incomplete['_id'],
+                               ignore=404)
+        return status
 
-        doc = {
-            'path': file,
-            'content': content.decode('utf-8', errors='ignore'),
-            'md5': file_md5,
-            'mdate': os.path.getmtime(file)
+    # bulk actions for a batch of read() results, existing - lookup() result for the batch;
+    # status of the file is counted with its document, which is the last action
+    def batch_actions(self, batch, existing, skip, status, pending):
+        for file, ret, doc in batch:
+            if doc is None:
+                if ret is not None:
+                    status[ret] += 1
+                continue
+            ret, file_actions = self.file2action(file=file, skip=skip, existing=existing, doc=doc)
+            if not file_actions:
+                status[ret] += 1
+                continue
+            for action in file_actions:
+                pending.append((ret if action.get('_source') is doc else None, action))
+                yield action
+
+    # counts result of the next pending action, returns (file_failed, action) where file_failed is True
+    # if an action of current file failed and action is document of split file to delete because some
+    # of its parts are not indexed, so the file is indexed again next time
+    def bulk_result(self, ok, item, pending, status, file_failed):
+        ret, action = pending.popleft()
+        if not ok:
+            file_failed = True
+            print('error: ', item)
+        if ret is None:
+            return file_failed, None
+        if not file_failed:
+            status[ret] += 1
+            self.indexed(action)
+            return False, None
+        status['failed'] += 1
+        if ok and 'parts' in action['_source']:
+            return False, action
+        return False, None
+
+    # reads (file, sniff) pairs with pool of workers, threads or processes, yields (file, status, doc)
+    # in the same order, status is set if file doesn't need to be read, doc is None if file is not read
+    # or not text; at most queue_depth files are read ahead of the consumer
+    def read(self, files, workers=1, queue_depth=None, processes=False):
+        if workers <= 1:
+            for file, sniff in files:
+                ret, st, sniff = self.check(file, sniff)
+                if ret is None and sniff is None:
+                    yield file, None, None
+                elif ret:
+                    yield file, ret, None
+                else:
+                    yield file, None, self.sniffed(st, sniff, read_doc(file, st, sniff, self.split_size, self.hash_name))
+            return
+
+        if queue_depth is None:
+            queue_depth = workers * 4
+        executor_class = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        queue = deque()
+        with executor_class(max_workers=workers) as executor:
+            for file, sniff in files:
+                ret, st, sniff = self.check(file, sniff)
+                future = None
+                if ret is None and sniff is not None:
+                    future = executor.submit(read_doc, file, st, sniff, self.split_size, self.hash_name)
+                queue.append((file, ret, st, sniff, future))
+                if len(queue) >= queue_depth:
+                    yield self.done(*queue.popleft())
+            while queue:
+                yield self.done(*queue.popleft())
+
+    def done(self, file, ret, st, sniff, future):
+        return file, ret, self.sniffed(st, sniff, future.result()) if future else None
+
+    # remember result of mime sniffing, returns doc
+    def sniffed(self, st, sniff, doc):
+        if sniff and self.manifest:
+            self.manifest.put_mime(st, doc is not None)
+        return doc
+
+    # returns (status, stat, sniff) of the file, status is set if file doesn't need to be read,
+    # sniff is None if file is known to be not text, False if it's known to be text
+    def check(self, file, sniff=False):
+        try:
+            st = os.stat(file)
+        except (OSError, TypeError, ValueError):
+            return 'not_found', None, sniff
+        if not stat.S_ISREG(st.st_mode):
+            return 'not_found', None, sniff
+        if self.manifest and self.manifest.unchanged(file, st):
+            return 'skipped', st, sniff
+        if sniff and self.manifest:
+            text = self.manifest.is_text(st)
+            if text is not None:
+                sniff = False if text else None
+        return None, st, sniff
+
+    def bulk(self, actions, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1):
+        if threads > 1:
+            return parallel_bulk(self.es, actions, thread_count=threads, chunk_size=chunk_size,
+                                 max_chunk_bytes=max_chunk_bytes, raise_on_error=False,
+                                 raise_on_exception=False)
+        return streaming_bulk(self.es, actions, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                              raise_on_error=False, raise_on_exception=False)
+
+    def file2index(self, file=None, skip=True, doc=None):
+        ret, actions = self.file2action(file=file, skip=skip, doc=doc)
+        if not actions:
+            return ret
+
+        for action in actions:
+            if action['_op_type'] == 'delete':
+                self.es.delete(index=action['_index'], doc_type=action['_type'], id=action['_id'], ignore=404)
+            else:
+                self.es.index(index=action['_index'], id=action['_id'], doc_type=action['_type'],
+                              body=action['_source'])
+        self.indexed(action)
+        if ret == 'updated':
+            print(file, ' updated')
+        return ret
+
+    # returns status and bulk actions to index the file, actions is None if nothing to index,
+    # the last action indexes document of the file, actions of split file are generated lazily;
+    # existing - result of lookup() for the file, fetched from index if not given,
+    # doc - result of read_doc() for the file, file is read if not given
+    def file2action(self, file=None, skip=True, existing=None, doc=None):
+        if doc is None:
+            ret, st, sniff = self.check(file)
+            if ret:
+                return ret, None
+            doc = read_doc(file, st, split_size=self.split_size, hash_name=self.hash_name)
+
+        file_hash = doc[self.hash_name]
+        if skip and bytes.fromhex(file_hash) in self.known_hashes():
+            # content of file already in index, skip it
+            return 'skipped', None
+
+        action = {
+            '_op_type': 'index',
+            '_index': self.index_of(file),
+            '_type': self.type,
+            '_id': doc_id(file),
+            '_source': doc
         }
 
-        res1 = self.es.search(index=INDEX, body={'query': {'term': {'path': doc['path']}}})
-        if not res1['hits']['hits']:
-            self.es.index(index=INDEX, doc_type=TYPE, body=doc)
-            return 'added'
-        else:
-            # if md5 not changed for the file - skip indexing
-            if not skip:
-                query = {
-                    "query": {
-                        "bool": {
-                            "must": {"match_all": {}},
-                            "filter": [
-                                {
-                                    "term": {
-                                        "md5": file_md5
-                                    }
-                                },
-                                {
-                                    "term": {
-                                        "path": file
-                                    }
-                                }
-                            ]
+        if existing is None:
+            existing = self.lookup([file])
+        if action['_id'] not in existing:
+            return 'added', self.file_actions(action)
+
+        # if content not changed for the file - skip indexing
+        if not skip and existing[action['_id']].get(self.hash_name) == file_hash:
+            self.indexed(action)
+            return 'skipped', None
+
+        return 'updated', self.file_actions(action, existing[action['_id']].get('parts', 0))
+
+    # actions to index document of the file, its parts and delete its parts left from previous version
+    def file_actions(self, action, old_parts=0):
+        parts = action['_source'].get('parts', 0)
+        if not parts and not old_parts:
+            return [action]
+
+        def actions():
+            file = action['_source']['path']
+            if parts:
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+                with open(file, 'rb') as f:
+                    for part, (offset, data) in enumerate(file_parts(f, self.split_size)):
+                        yield {
+                            '_op_type': 'index',
+                            '_index': action['_index'],
+                            '_type': self.type,
+                            '_id': part_id(file, part),
+                            '_source': {
+                                'path': file,
+                                'part': part,
+                                'offset': offset,
+                                'content': decoder.decode(data)
+                            }
                         }
-                    }
+            for part in range(parts, old_parts):
+                yield {
+                    '_op_type': 'delete',
+                    '_index': action['_index'],
+                    '_type': self.type,
+                    '_id': part_id(file, part)
                 }
-                res2 = self.es.search(index=INDEX, body=query)
-                if res2['hits']['hits'] != []:
-                    # print(file, ' skipped')
-                    return 'skipped'
-                    # continue
-
-            # update document
-            self.es.index(index=INDEX, id=res1['hits']['hits'][0]['_id'], doc_type=TYPE, body=doc)
-            print(file, ' updated')
-            return 'updated'
+            yield action
 
-    # update index for each file already in index
-    def update(self):
+        return actions()
 
-        update_status = {
-            'skipped': 0,
-            'added': 0,
-            'updated': 0,
-            'not_found': 0
-        }
+    # remember file indexed by the action in manifest and its content hash
+    def indexed(self, action):
+        doc = action['_source']
+        if self.manifest:
+            self.manifest.put(doc['path'], doc['mdate'], doc['size'], doc[self.hash_name])
+        if self.hashes is not None:
+            self.hashes.add(bytes.fromhex(doc[self.hash_name]))
+
+    # content hashes of all documents in index as set of digests, loaded once per run
+    # instead of a search per file
+    def known_hashes(self):
+        if self.hashes is None:
+            query = {"query": {"exists": {"field": self.hash_name}}, "_source": [self.hash_name]}
+            self.hashes = set(bytes.fromhex(doc['_source'][self.hash_name])
+                              for doc in scan(self.es, query=query, index=self.index, doc_type=self.type,
+                                              size=SCROLL_SIZE))
+        return self.hashes
+
+    # content hashes of documents matched by query, read before they are deleted to forget() them
+    def hashes_of(self, query):
+        if self.hashes is None:
+            return []
+        return [doc['_source'].get(self.hash_name)
+                for doc in scan(self.es, query={"query": query, "_source": [self.hash_name]}, index=self.index,
+                                doc_type=self.type, size=SCROLL_SIZE)]
+
+    # remove content hashes of deleted documents from known_hashes(), the set stays loaded;
+    # content still in other documents is indexed again instead of skipped
+    def forget(self, hashes):
+        if self.hashes is not None:
+            self.hashes.difference_update(bytes.fromhex(value) for value in hashes if value)
+
+    # content hash of files already in index with one request, returns dict document id -> _source
+    def lookup(self, files):
+        if not files:
+            return {}
+        res = self.es.mget(index=self.index, doc_type=self.type, body=self.lookup_body(files),
+                           _source=[self.hash_name, 'parts'])
+        return {doc['_id']: doc['_source'] for doc in res['docs'] if doc.get('found')}
+
+    # documents are addressed in their partitions, get by id doesn't work with alias of many indices
+    def lookup_body(self, files):
+        return {'docs': [{'_index': self.index_of(file), '_id': doc_id(file)} for file in files]}
+
+    # update index for each file already in index
+    def update(self, bulk=False, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1,
+               workers=1, queue_depth=None, processes=False):
 
-        for file in self.list(fields=['path']):
-            ret = self.file2index(file=file['_source']['path'], skip=False)
-            # print(file['_source']['path'])
-            update_status[ret] += 1
+        files = ((file['_source']['path'], False) for file in self.list(fields=['path'], parts=False))
+        update_status = self.index_files(files, skip=False, bulk=bulk, chunk_size=chunk_size,
+                                         max_chunk_bytes=max_chunk_bytes, threads=threads, workers=workers,
+                                         queue_depth=queue_depth, processes=processes)
 
         print('added: ', update_status['added'], ' updated: ', update_status['updated'], 'skipped: ',
-              update_status['skipped'], 'not found: ', update_status['not_found'])
+              update_status['skipped'], 'not found: ', update_status['not_found'], 'failed: ',
+              update_status['failed'])
 
-    def list(self, fields=["path", "md5", "mdate"]):
+    # parts=False - without documents of split files parts
+    def list(self, fields=["path", "mdate"], parts=True, size=1000):
+        query = {"match_all": {}}
+        if not parts:
+            query = {"bool": {"must_not": {"exists": {"field": "part"}}}}
         return scan(self.es,
-                    query={"query": {"match_all": {}}, "_source": ['path'], "_source": fields},
-                    index=INDEX,
-                    doc_type=TYPE
+                    query={"query": query, "_source": fields},
+                    index=self.index,
+                    doc_type=self.type,
+                    size=size
                     )
 
     # remove files from index which already removed from fs
-    def cleanup(self):
-        for file in self.list(fields=['path']):
-            if not os.path.isfile(file['_source']['path']):
-                print('deleted from index', file['_source']['path'])
-                self.es.delete(index=INDEX, doc_type=TYPE, id=file['_id'])
+    # files are checked by directories: one os.scandir for all documents of a scroll page in the same directory
+    def cleanup(self, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1,
+                scroll_size=SCROLL_SIZE):
+
+        # directories with many files are listed once for many pages
+        dir_files = lru_cache(maxsize=256)(file_names)
+        pending = deque()
+
+        def actions():
+            for page in batches(self.list(fields=['path', self.hash_name], size=scroll_size), scroll_size):
+                for source, action in self.missing(page, dir_files):
+                    pending.append(source)
+                    yield action
+
+        deleted = 0
+        for ok, item in self.bulk(actions(), chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                  threads=threads):
+            source = pending.popleft()
+            if not ok:
+                print('error: ', item)
+                continue
+            print('deleted from index', source['path'])
+            deleted += 1
+            self.forget([source.get(self.hash_name)])
+            if self.manifest:
+                self.manifest.delete(source['path'])
+        return deleted
+
+    # yields (_source, delete action) for documents of the scroll page whose files are removed from fs
+    def missing(self, page, dir_files):
+        by_dir = {}
+        for file in page:
+            directory, name = os.path.split(file['_source']['path'])
+            by_dir.setdefault(directory, []).append((name, file))
+        for directory, files in by_dir.items():
+            names = dir_files(directory)
+            for name, file in files:
+                if names is None:
+                    # directory can't be listed, its files are checked one by one
+                    removed = not file_exists(file['_source']['path'])
+                else:
+                    removed = name not in names
+                if removed:
+                    yield file['_source'], {
+                        '_op_type': 'delete',
+                        '_index': file['_index'],
+                        '_type': self.type,
+                        '_id': file['_id']
+                    }
 
     def find_by_path(self, path=None):
+        res = self.es.get(index=self.index_of(path), doc_type=self.type, id=doc_id(path), ignore=404)
+        if res.get('found'):
+            return res
+
+        # documents indexed before --rekey have auto-generated ids
         query = {
             "query": {
                 "bool": {
@@ -260,24 +925,728 @@ class ElasticData(object):
             }
         }
 
-        res = self.es.search(index=INDEX, doc_type=TYPE, body=query)
+        res = self.es.search(index=self.index, doc_type=self.type, body=query)
         if res['hits']['hits']:
             return res['hits']['hits'][0]
         else:
             return None
 
-    def delete_by_path(self, path=None):
+    # move documents with auto-generated ids to ids derived from path, returns number of moved documents
+    def rekey(self, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1):
+        def actions():
+            for doc in scan(self.es, query={"query": {"match_all": {}}}, index=self.index, doc_type=self.type):
+                if 'part' in doc['_source']:
+                    # parts of split files have ids derived from path already
+                    continue
+                new_id = doc_id(doc['_source']['path'])
+                if doc['_id'] == new_id:
+                    continue
+                yield {
+                    '_op_type': 'index',
+                    '_index': doc['_index'],
+                    '_type': self.type,
+                    '_id': new_id,
+                    '_source': doc['_source']
+                }
+                yield {
+                    '_op_type': 'delete',
+                    '_index': doc['_index'],
+                    '_type': self.type,
+                    '_id': doc['_id']
+                }
+
+        moved = 0
+        failed = 0
+        for ok, item in self.bulk(actions(), chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                  threads=threads):
+            if not ok:
+                failed += 1
+                print('error: ', item)
+            elif 'index' in item:
+                moved += 1
+        if not failed:
+            self.es.indices.put_mapping(index=self.index, doc_type=self.type, body={'_meta': self.meta()})
+            self.rekeyed = True
+        return moved
+
+    # content of split file, part by part
+    def get_parts(self, doc):
+        for part in range(doc['_source']['parts']):
+            res = self.es.get(index=doc['_index'], doc_type=self.type, id=part_id(doc['_source']['path'], part),
+                              ignore=404)
+            if res.get('found'):
+                yield res['_source']['content']
+
+    # query for path and everything under it
+    def path_query(self, path):
+        if path != '/':
+            path = path.rstrip('/')
+        if self.has_path_tree():
+            if path == '/':
+                return {"match_all": {}}
+            return {"term": {"path.tree": path}}
+
+        # index created by older version without path.tree, see --upgrade
+        return {
+            "bool": {
+                "should": [
+                    {"term": {"path": path}},
+                    {"prefix": {"path": path if path == '/' else path + '/'}}
+                ]
+            }
+        }
+
+    def has_path_tree(self):
+        if self.path_tree is None:
+            res = self.es.indices.get_field_mapping(index=self.index, fields='path.tree')
+            self.path_tree = any(mapping for index in res.values() for mapping in index['mappings'].values())
+        return self.path_tree
+
+    # number of files under the path
+    def count_by_path(self, path=None):
         query = {
             "query": {
-                "regexp": {
-                    "path": {
-                        "value": "{}.*".format(path)
+                "bool": {
+                    "filter": self.path_query(path),
+                    "must_not": {"exists": {"field": "part"}}
+                }
+            }
+        }
+        return self.es.count(index=self.index, doc_type=self.type, body=query)['count']
+
+    def delete_by_path(self, path=None):
+        query = {
+            "query": self.path_query(path)
+        }
+
+        if self.manifest:
+            self.manifest.delete_tree(path)
+        hashes = self.hashes_of(query['query'])
+        res = self.es.delete_by_query(index=self.index, doc_type=self.type, body=query, conflicts='proceed',
+                                      slices='auto', wait_for_completion=False)
+        res = self.wait_task(res['task'])
+        self.forget(hashes)
+        return res
+
+    # delete files and directories with everything under them, returns number of deleted documents
+    def delete_paths(self, paths, batch_size=500):
+        deleted = 0
+        for batch in batches(paths, batch_size):
+            query = {
+                "query": {
+                    "bool": {
+                        "should": [self.path_query(path) for path in batch]
                     }
                 }
             }
+            if self.manifest:
+                for path in batch:
+                    self.manifest.delete_tree(path)
+            hashes = self.hashes_of(query['query'])
+            deleted += self.es.delete_by_query(index=self.index, doc_type=self.type, body=query,
+                                               conflicts='proceed')['deleted']
+            self.forget(hashes)
+        return deleted
+
+    # add path.tree to index created by older version: analysis settings can be changed only on closed index,
+    # then all documents are updated in place to fill the new field
+    def upgrade(self):
+        analysis = self.map['settings']['analysis']
+        self.es.indices.close(index=self.index)
+        try:
+            self.es.indices.put_settings(index=self.index, body={
+                'analysis': {
+                    'tokenizer': {'path_tokenizer': analysis['tokenizer']['path_tokenizer']},
+                    'analyzer': {'path_analyzer': analysis['analyzer']['path_analyzer']}
+                }
+            })
+        finally:
+            self.es.indices.open(index=self.index)
+        self.es.cluster.health(index=self.index, wait_for_status='yellow')
+
+        path = self.map['mappings'][self.type]['properties']['path']
+        self.es.indices.put_mapping(index=self.index, doc_type=self.type, body={'properties': {'path': path}})
+        self.path_tree = True
+        res = self.es.update_by_query(index=self.index, doc_type=self.type, conflicts='proceed', slices='auto',
+                                      wait_for_completion=False)
+        return self.wait_task(res['task'])
+
+    # wait for background task with progress printed, returns task response
+    def wait_task(self, task_id, interval=2):
+        while True:
+            task = self.es.tasks.get(task_id=task_id)
+            if task.get('completed'):
+                return task['response']
+            status = task['task']['status']
+            print('progress: {}/{}'.format(status['updated'] + status['created'] + status['deleted'],
+                                          status['total']))
+            sleep(interval)
+
+    # move documents of single index to partitions behind alias with the same name: the index is copied
+    # to temporary one and deleted, then documents are indexed from the copy to their partitions;
+    # after failure it's run again and continues from the copy once the index is deleted; returns number
+    # of moved documents, None if the copy is incomplete (the index is kept then) or there is nothing to move
+    def migrate(self, partition_depth, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1):
+        copy = self.index + '.migrate'
+        if self.es.indices.exists_alias(name=self.index):
+            if not self.es.indices.exists(index=copy):
+                print('warning: {} is already partitioned'.format(self.index))
+                return 0
+        elif self.es.indices.exists(index=self.index):
+            # copy left by interrupted reindex is incomplete
+            self.es.indices.delete(index=copy, ignore=404)
+            self.es.indices.create(index=copy, body=self.index_map())
+            total = self.es.count(index=self.index)['count']
+            res = self.es.reindex(body={'source': {'index': self.index}, 'dest': {'index': copy}},
+                                  wait_for_completion=False)
+            response = self.wait_task(res['task'])
+            if response.get('failures') or response.get('created') != total:
+                print('error: copy of {} is incomplete, {} of {} documents copied, index is kept'.format(
+                    self.index, response.get('created'), total))
+                for failure in response.get('failures', [])[:10]:
+                    print('error: ', failure)
+                return None
+            self.es.indices.refresh(index=copy)
+            self.es.indices.delete(index=self.index)
+        elif not self.es.indices.exists(index=copy):
+            print('error: {} doesn\'t exist'.format(self.index))
+            return None
+
+        self.partition_depth = partition_depth
+        self.es.indices.put_template(name=self.index, body=self.template())
+        self.es.indices.create(index=self.index_of(''), ignore=400)
+
+        def actions():
+            for doc in scan(self.es, query={"query": {"match_all": {}}}, index=copy, doc_type=self.type,
+                            size=SCROLL_SIZE):
+                yield {
+                    '_op_type': 'index',
+                    '_index': self.index_of(doc['_source']['path']),
+                    '_type': self.type,
+                    '_id': doc['_id'],
+                    '_source': doc['_source']
+                }
+
+        moved = 0
+        failed = 0
+        for ok, item in self.bulk(actions(), chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                  threads=threads):
+            if ok:
+                moved += 1
+            else:
+                failed += 1
+                print('error: ', item)
+        if not failed:
+            self.es.indices.delete(index=copy)
+        return moved
+
+    # refresh is disabled while loading many documents and restored afterwards,
+    # partitions created meanwhile have default refresh
+    @contextlib.contextmanager
+    def bulk_load(self):
+        saved = refresh_intervals(self.es.indices.get_settings(index=self.index, name='index.refresh_interval'))
+        self.es.indices.put_settings(index=self.index, body={'index': {'refresh_interval': '-1'}})
+        try:
+            yield
+        finally:
+            for index, interval in saved.items():
+                self.es.indices.put_settings(index=index, body={'index': {'refresh_interval': interval}})
+            self.es.indices.refresh(index=self.index)
+
+
+# ElasticData on AsyncElasticsearch for high latency links: up to concurrency requests are in flight
+# over one pool of connections while next batches of files are read; import_docs, update and cleanup
+# are coroutines, search is an async generator; documents are always sent with bulk API
+class AsyncElasticData(ElasticData):
+
+    def __init__(self, elastic_hosts, index, type, map, manifest=None, split_size=SPLIT_SIZE, hash_name=HASH,
+                 partition_depth=0, shards=None, replicas=None, concurrency=CONCURRENCY):
+        super().__init__(elastic_hosts, index, type, map, manifest=manifest, split_size=split_size,
+                         hash_name=hash_name, partition_depth=partition_depth, shards=shards, replicas=replicas)
+        self.concurrency = concurrency
+        self.es = AsyncElasticsearch(self.elastic_hosts, maxsize=concurrency)
+        # created in connect(), in the running event loop
+        self.semaphore = None
+
+    async def connect(self):
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.connected = await self.es.ping()
+        if self.connected:
+            if await self.es.indices.exists_alias(name=self.index):
+                self.partitioned(await self.es.indices.get_mapping(index=self.index))
+                await self.es.indices.put_template(name=self.index, body=self.template())
+            elif await self.es.indices.exists(index=self.index):
+                self.not_partitioned(await self.es.indices.get_mapping(index=self.index))
+            else:
+                if self.partition_depth:
+                    await self.es.indices.put_template(name=self.index, body=self.template())
+                    await self.es.indices.create(index=self.index_of(''), ignore=400)
+                else:
+                    await self.es.indices.create(index=self.index, body=self.index_map())
+                if self.manifest:
+                    self.manifest.clear()
+            # path_query() makes no requests after this
+            res = await self.es.indices.get_field_mapping(index=self.index, fields='path.tree')
+            self.path_tree = any(mapping for index in res.values() for mapping in index['mappings'].values())
+
+    async def close(self):
+        await self.es.close()
+
+    @contextlib.asynccontextmanager
+    async def bulk_load(self):
+        saved = refresh_intervals(await self.es.indices.get_settings(index=self.index,
+                                                                     name='index.refresh_interval'))
+        await self.es.indices.put_settings(index=self.index, body={'index': {'refresh_interval': '-1'}})
+        try:
+            yield
+        finally:
+            for index, interval in saved.items():
+                await self.es.indices.put_settings(index=index, body={'index': {'refresh_interval': interval}})
+            await self.es.indices.refresh(index=self.index)
+
+    # waits for a free slot, at most concurrency requests run at once
+    async def request(self, coro):
+        async with self.semaphore:
+            return await coro
+
+    # runs coroutine as a task in tasks, waits while concurrency tasks are running
+    async def spawn(self, tasks, coro):
+        tasks.add(asyncio.ensure_future(coro))
+        if len(tasks) >= self.concurrency:
+            done, running = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            tasks.difference_update(done)
+            for task in done:
+                task.result()
+
+    async def search(self, q, path=None, size=10, from_=0, search_after=None, fragment_size=150,
+                     number_of_fragments=3, source=('path', 'part', 'offset'), track_total_hits=False):
+        body = self.search_body(q, path=path, size=size, from_=from_, search_after=search_after,
+                                fragment_size=fragment_size, number_of_fragments=number_of_fragments, source=source,
+                                track_total_hits=track_total_hits)
+        res = await self.request(self.es.search(index=self.index, body=body))
+        for item in res['hits']['hits']:
+            yield item
+
+    async def import_docs(self, paths=None, bulk=True, chunk_size=BULK_CHUNK_SIZE,
+                          max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1, workers=1, queue_depth=None,
+                          processes=False, text_ext=TEXT_EXTENSIONS, skip_ext=SKIP_EXTENSIONS, min_size=1,
+                          max_size=None):
+
+        if paths is None:
+            print('warning: nothing to index')
+            sys.exit(1)
+        if not self.connected:
+            sys.exit(1)
+
+        if type(paths) is str:
+            paths = [paths]
+
+        files = self.walk(paths, text_ext=text_ext, skip_ext=skip_ext, min_size=min_size, max_size=max_size)
+        import_status = await self.index_files(files, skip=True, verbose=not bulk, chunk_size=chunk_size,
+                                               max_chunk_bytes=max_chunk_bytes, workers=workers,
+                                               queue_depth=queue_depth, processes=processes)
+
+        print('added: ', import_status['added'], ' updated: ', import_status['updated'], 'skipped: ',
+              import_status['skipped'], 'failed: ', import_status['failed'])
+
+    # bulk and threads are accepted for the same signature as ElasticData.index_files()
+    async def index_files(self, files, skip=True, verbose=False, bulk=True, chunk_size=BULK_CHUNK_SIZE,
+                          max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1, workers=1, queue_depth=None,
+                          processes=False):
+        status = {
+            'skipped': 0,
+            'added': 0,
+            'updated': 0,
+            'not_found': 0,
+            'failed': 0
         }
+        if skip:
+            await self.load_hashes()
+
+        # files are read in a thread, so the next batch is read while previous ones are sent
+        docs = self.read(files, workers=workers, queue_depth=queue_depth, processes=processes)
+        loop = asyncio.get_event_loop()
+        tasks = set()
+        while True:
+            batch = await loop.run_in_executor(None, lambda: list(islice(docs, chunk_size)))
+            if not batch:
+                break
+            await self.spawn(tasks, self.index_batch(batch, skip, verbose, chunk_size, max_chunk_bytes, status))
+        if tasks:
+            await asyncio.gather(*tasks)
+        return status
+
+    async def index_batch(self, batch, skip, verbose, chunk_size, max_chunk_bytes, status):
+        if verbose:
+            for file, ret, doc in batch:
+                if doc is not None:
+                    print(file)
+        existing = await self.lookup([file for file, ret, doc in batch if doc is not None])
+
+        pending = deque()
+        incomplete = []
+        file_failed = False
+        actions = self.batch_actions(batch, existing, skip, status, pending)
+        async with self.semaphore:
+            async for ok, item in async_streaming_bulk(self.es, actions, chunk_size=chunk_size,
+                                                       max_chunk_bytes=max_chunk_bytes, raise_on_error=False,
+                                                       raise_on_exception=False):
+                file_failed, action = self.bulk_result(ok, item, pending, status, file_failed)
+                if action:
+                    incomplete.append(action)
+        for action in incomplete:
+            await self.request(self.es.delete(index=action['_index'], doc_type=action['_type'], id=action['_id'],
+                                              ignore=404))
 
-        return self.es.delete_by_query(index=INDEX, doc_type=TYPE, body=query)
+    # content hashes for known_hashes(), loaded before indexing
+    async def load_hashes(self):
+        if self.hashes is None:
+            query = {"query": {"exists": {"field": self.hash_name}}, "_source": [self.hash_name]}
+            hashes = set()
+            async for doc in async_scan(self.es, query=query, index=self.index, doc_type=self.type,
+                                        size=SCROLL_SIZE):
+                hashes.add(bytes.fromhex(doc['_source'][self.hash_name]))
+            self.hashes = hashes
+
+    async def lookup(self, files):
+        if not files:
+            return {}
+        res = await self.request(self.es.mget(index=self.index, doc_type=self.type, body=self.lookup_body(files),
+                                              _source=[self.hash_name, 'parts']))
+        return {doc['_id']: doc['_source'] for doc in res['docs'] if doc.get('found')}
+
+    # files already in index are indexed by scroll pages
+    async def update(self, bulk=True, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1,
+                     workers=1, queue_depth=None, processes=False, scroll_size=SCROLL_SIZE):
+        update_status = {}
+
+        async def index_page(page):
+            status = await self.index_files(page, skip=False, chunk_size=chunk_size,
+                                            max_chunk_bytes=max_chunk_bytes, workers=workers,
+                                            queue_depth=queue_depth, processes=processes)
+            for key, value in status.items():
+                update_status[key] = update_status.get(key, 0) + value
+
+        page = []
+        async for file in self.list(fields=['path'], parts=False, size=scroll_size):
+            page.append((file['_source']['path'], False))
+            if len(page) >= scroll_size:
+                await index_page(page)
+                page = []
+        await index_page(page)
+
+        print('added: ', update_status['added'], ' updated: ', update_status['updated'], 'skipped: ',
+              update_status['skipped'], 'not found: ', update_status['not_found'], 'failed: ',
+              update_status['failed'])
+
+    # async iterator
+    def list(self, fields=["path", "mdate"], parts=True, size=1000):
+        query = {"match_all": {}}
+        if not parts:
+            query = {"bool": {"must_not": {"exists": {"field": "part"}}}}
+        return async_scan(self.es,
+                          query={"query": query, "_source": fields},
+                          index=self.index,
+                          doc_type=self.type,
+                          size=size
+                          )
+
+    # scroll pages are checked in a thread and deleted while next pages are read
+    async def cleanup(self, chunk_size=BULK_CHUNK_SIZE, max_chunk_bytes=BULK_MAX_CHUNK_BYTES, threads=1,
+                      scroll_size=SCROLL_SIZE):
+        dir_files = lru_cache(maxsize=256)(file_names)
+        status = {'deleted': 0}
+        tasks = set()
+        page = []
+        async for file in self.list(fields=['path', self.hash_name], size=scroll_size):
+            page.append(file)
+            if len(page) >= scroll_size:
+                await self.spawn(tasks, self.cleanup_page(page, dir_files, chunk_size, max_chunk_bytes, status))
+                page = []
+        if page:
+            await self.spawn(tasks, self.cleanup_page(page, dir_files, chunk_size, max_chunk_bytes, status))
+        if tasks:
+            await asyncio.gather(*tasks)
+        return status['deleted']
+
+    async def cleanup_page(self, page, dir_files, chunk_size, max_chunk_bytes, status):
+        loop = asyncio.get_event_loop()
+        missing = await loop.run_in_executor(None, lambda: list(self.missing(page, dir_files)))
+        if not missing:
+            return
+        async with self.semaphore:
+            results = [result async for result in
+                       async_streaming_bulk(self.es, [action for source, action in missing], chunk_size=chunk_size,
+                                            max_chunk_bytes=max_chunk_bytes, raise_on_error=False,
+                                            raise_on_exception=False)]
+        for (source, action), (ok, item) in zip(missing, results):
+            if not ok:
+                print('error: ', item)
+                continue
+            print('deleted from index', source['path'])
+            status['deleted'] += 1
+            self.forget([source.get(self.hash_name)])
+            if self.manifest:
+                self.manifest.delete(source['path'])
+
+
+# keeps index in sync with directories: inotify events (or periodic polling of directories when inotify
+# is not available or its watches run out) are debounced, then changed files are indexed in bulk
+# and removed ones are deleted from index
+class Watcher(object):
+
+    def __init__(self, docs, paths, debounce=DEBOUNCE, max_delay=MAX_DELAY, poll_interval=POLL_INTERVAL,
+                 text_ext=TEXT_EXTENSIONS, skip_ext=SKIP_EXTENSIONS, min_size=1, max_size=None, index_args=None):
+        self.docs = docs
+        self.paths = paths
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.text_ext = set(ext.lower() for ext in text_ext)
+        self.skip_ext = set(ext.lower() for ext in skip_ext)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.index_args = index_args or {}
+
+        self.to_index = set()
+        self.to_delete = set()
+        self.first_event = None
+        self.last_event = None
+        # inotify watch descriptor -> directory
+        self.watches = {}
+        # directory -> {name: (is_dir, mtime, size)} for polled directories
+        self.polled = {}
+        self.inotify = None
+        if INotify:
+            self.inotify = INotify()
+            self.mask = flags.CREATE | flags.CLOSE_WRITE | flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE
+        else:
+            print('warning: inotify_simple is not installed, directories are polled')
+        for path in paths:
+            self.add_dir(path)
+        self.last_poll = monotonic()
+
+    def run(self):
+        while True:
+            if self.watches:
+                self.read_events(self.debounce)
+            else:
+                sleep(self.debounce)
+
+            now = monotonic()
+            if self.polled and now - self.last_poll >= self.poll_interval:
+                self.poll()
+                self.last_poll = now
+            if self.first_event is not None and (now - self.last_event >= self.debounce or
+                                                 now - self.first_event >= self.max_delay):
+                self.flush()
+
+    def add_dir(self, path):
+        dirs = [path]
+        while dirs:
+            directory = dirs.pop()
+            self.watch(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    dirs.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                continue
+
+    def watch(self, directory):
+        if self.inotify:
+            try:
+                self.watches[self.inotify.add_watch(directory, self.mask)] = directory
+                return
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    return
+                print('warning: inotify watches exhausted, polling', directory)
+        snapshot = self.snapshot(directory)
+        if snapshot is not None:
+            self.polled[directory] = snapshot
+
+    def unwatch(self, path):
+        prefix = path.rstrip('/') + '/'
+        for wd, directory in list(self.watches.items()):
+            if directory == path or directory.startswith(prefix):
+                del self.watches[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+        for directory in list(self.polled):
+            if directory == path or directory.startswith(prefix):
+                del self.polled[directory]
+
+    def read_events(self, timeout):
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & flags.Q_OVERFLOW:
+                self.overflow()
+                continue
+            directory = self.watches.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                # directory removed
+                del self.watches[event.wd]
+                continue
+            path = os.path.join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self.add_dir(path)
+                    self.created_dir(path)
+                elif event.mask & flags.MOVED_FROM:
+                    self.unwatch(path)
+                    self.deleted(path)
+                elif event.mask & flags.DELETE:
+                    self.deleted(path)
+            elif event.mask & (flags.CLOSE_WRITE | flags.MOVED_TO):
+                self.changed(path)
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                self.deleted(path)
+
+    # events are lost when inotify queue overflows: all files are indexed again (unchanged are skipped) and
+    # directories created meanwhile are watched, files removed meanwhile are left to --cleanup
+    def overflow(self):
+        print('warning: inotify events lost, rescanning', ' '.join(self.paths))
+        for path in self.paths:
+            self.add_dir(path)
+            self.created_dir(path)
+
+    def snapshot(self, directory):
+        try:
+            with os.scandir(directory) as entries:
+                snapshot = {}
+                for entry in entries:
+                    st = entry.stat(follow_symlinks=False)
+                    snapshot[entry.name] = (entry.is_dir(follow_symlinks=False), st.st_mtime, st.st_size)
+                return snapshot
+        except OSError:
+            return None
+
+    def poll(self):
+        for directory, old in list(self.polled.items()):
+            if directory not in self.polled:
+                # removed while polling parent directory
+                continue
+            new = self.snapshot(directory)
+            if new is None:
+                self.unwatch(directory)
+                self.deleted(directory)
+                continue
+            self.polled[directory] = new
+            for name, info in new.items():
+                path = os.path.join(directory, name)
+                if info == old.get(name):
+                    continue
+                if not info[0]:
+                    self.changed(path)
+                elif name not in old:
+                    self.add_dir(path)
+                    self.created_dir(path)
+            for name in old.keys() - new.keys():
+                path = os.path.join(directory, name)
+                if old[name][0]:
+                    self.unwatch(path)
+                self.deleted(path)
+
+    def created_dir(self, path):
+        for file, sniff in self.docs.walk([path], text_ext=[], skip_ext=[], min_size=0):
+            self.changed(file)
+
+    def changed(self, path):
+        self.to_delete.discard(path)
+        self.to_index.add(path)
+        self.event()
+
+    def deleted(self, path):
+        self.to_index.discard(path)
+        self.to_delete.add(path)
+        self.event()
+
+    def event(self):
+        self.last_event = monotonic()
+        if self.first_event is None:
+            self.first_event = self.last_event
+
+    # on Elastic error the changes are kept and flushed again after debounce
+    def flush(self):
+        to_index, self.to_index = self.to_index, set()
+        to_delete, self.to_delete = self.to_delete, set()
+        self.first_event = None
+        try:
+            self.flush_changes(to_index, to_delete)
+        except ElasticsearchException as e:
+            print('error: ', e)
+            self.to_index |= to_index
+            self.to_delete |= to_delete
+            self.event()
+
+    def flush_changes(self, to_index, to_delete):
+        if to_delete:
+            print('deleted: ', self.docs.delete_paths(sorted(to_delete)))
+            # make deletions visible, else renamed files are skipped as known content
+            self.docs.es.indices.refresh(index=self.docs.index)
+
+        files = []
+        for path in to_index:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            sniff = file_filter(os.path.basename(path), lambda: st.st_size, self.text_ext, self.skip_ext,
+                                min_size=self.min_size, max_size=self.max_size)
+            if sniff is not None:
+                files.append((path, sniff))
+        if files:
+            status = self.docs.index_files(files, skip=True, **self.index_args)
+            print('added: ', status['added'], ' updated: ', status['updated'], 'skipped: ', status['skipped'],
+                  'failed: ', status['failed'])
+
+        if self.docs.manifest:
+            self.docs.manifest.commit()
+
+
+def print_hits(hits):
+    for item in hits:
+        if 'part' in item['_source']:
+            print(item['_score'], item['_source']['path'],
+                  '(part {}, offset {})'.format(item['_source']['part'], item['_source']['offset']))
+        else:
+            print(item['_score'], item['_source']['path'])
+        for hl in item.get('highlight', {}).get('content', []):
+            print('<<<\n', hl, '\n>>>')
+        print('-' * 50)
+
+
+# --async: --add, --update, --cleanup and --search with AsyncElasticData
+async def run_async(docs, args, index_args):
+    await docs.connect()
+    try:
+        if not docs.is_connected():
+            print('error: can\'t establish connection to Elastic')
+            sys.exit(1)
+
+        if (args.add or args.update) and not docs.rekeyed:
+            print('error: {} has documents indexed by older version, run --rekey first'.format(docs.index))
+            sys.exit(1)
+
+        if args.search:
+            print_hits([item async for item in docs.search(args.search, path=args.path, size=args.size,
+                                                           from_=args.from_, fragment_size=args.fragment_size,
+                                                           number_of_fragments=args.fragments)])
+        elif args.update:
+            async with docs.bulk_load() if args.bulk_load else contextlib.AsyncExitStack():
+                await docs.update(scroll_size=args.scroll_size, **index_args)
+        elif args.cleanup:
+            print('deleted: ', await docs.cleanup(chunk_size=args.chunk_size, max_chunk_bytes=args.max_chunk_bytes,
+                                                  scroll_size=args.scroll_size))
+        elif args.add:
+            async with docs.bulk_load() if args.bulk_load else contextlib.AsyncExitStack():
+                await docs.import_docs(paths=args.add, text_ext=args.text_ext, skip_ext=args.skip_ext,
+                                       min_size=args.min_size, max_size=args.max_size, **index_args)
+    finally:
+        await docs.close()
 
 
 if __name__ == '__main__':
@@ -285,12 +1654,6 @@ if __name__ == '__main__':
     el_logger = logging.getLogger('elasticsearch')
     el_logger.setLevel(logging.ERROR)
 
-    docs = ElasticData(elastic_hosts=ELASTIC_HOSTS, index=INDEX, type=TYPE, map=MAP)
-    docs.connect()
-    if not docs.is_connected():
-        print('error: can\'t establish connection to Elastic')
-        sys.exit(1)
-
     parser = argparse.ArgumentParser(description='search in ElasticSearch')
 
     group1 = parser.add_mutually_exclusive_group()
@@ -303,42 +1666,194 @@ if __name__ == '__main__':
                         help="update index for each file already in index")
     group1.add_argument("-c", "--cleanup", dest="cleanup", action="store_true",
                         help="remove files from index which already removed from fs")
+    group1.add_argument("--count", dest="count", type=str, help="number of files in index under the path")
+    group1.add_argument("--upgrade", dest="upgrade", action="store_true",
+                        help="add path hierarchy field to index created by older version, "
+                             "makes --delete/--count/--path fast")
+    group1.add_argument("-w", "--watch", dest="watch", nargs='+',
+                        help="index changes in directories as they happen, until interrupted")
+    group1.add_argument("--rekey", dest="rekey", action="store_true",
+                        help="move documents indexed by older versions to ids derived from path, "
+                             "--add/--update/--watch/--migrate refuse such index until it's run")
+    group1.add_argument("--migrate", dest="migrate", action="store_true",
+                        help="move documents of single index to partitions by --partition-depth")
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1,
+                        help="number of workers reading and hashing files for --add and --update (default: %(default)s)")
+    parser.add_argument("--queue-depth", dest="queue_depth", type=int,
+                        help="max number of files read ahead of indexing (default: 4 per worker)")
+    parser.add_argument("--processes", dest="processes", action="store_true",
+                        help="use worker processes instead of threads, for CPU bound decoding of big files")
+    parser.add_argument("--debounce", dest="debounce", type=float, default=DEBOUNCE,
+                        help="--watch indexes changes after no new events for this time (seconds) (default: %(default)s)")
+    parser.add_argument("--poll-interval", dest="poll_interval", type=float, default=POLL_INTERVAL,
+                        help="--watch polls directories without inotify watch this often (seconds) "
+                             "(default: %(default)s)")
+    parser.add_argument("--text-ext", dest="text_ext", nargs='*', default=TEXT_EXTENSIONS,
+                        help="extensions of files indexed by --add without mime sniffing (default: %(default)s)")
+    parser.add_argument("--skip-ext", dest="skip_ext", nargs='*', default=SKIP_EXTENSIONS,
+                        help="extensions of files never indexed by --add (default: %(default)s)")
+    parser.add_argument("--min-size", dest="min_size", type=int, default=1,
+                        help="skip smaller files (bytes) found by --add (default: %(default)s)")
+    parser.add_argument("--max-size", dest="max_size", type=int,
+                        help="skip bigger files (bytes) found by --add")
+    parser.add_argument("--partition-depth", dest="partition_depth", type=int, default=0,
+                        help="index files to partitions per share, named after first N directories of path, "
+                             "behind alias with index name; used when index is created (default: %(default)s)")
+    parser.add_argument("--shards", dest="shards", type=int, help="number of shards of new index or partition")
+    parser.add_argument("--replicas", dest="replicas", type=int,
+                        help="number of replicas of new index or partition")
+    parser.add_argument("--bulk-load", dest="bulk_load", action="store_true",
+                        help="disable index refresh while --add/--update, restored afterwards")
+    parser.add_argument("-p", "--path", dest="path", type=str, help="search only in files under the path")
+    parser.add_argument("--size", dest="size", type=int, default=10,
+                        help="number of search results (default: %(default)s)")
+    parser.add_argument("--from", dest="from_", type=int, default=0,
+                        help="skip first search results (default: %(default)s)")
+    parser.add_argument("--fragment-size", dest="fragment_size", type=int, default=150,
+                        help="size of highlighted fragment in characters (default: %(default)s)")
+    parser.add_argument("--fragments", dest="fragments", type=int, default=3,
+                        help="max number of highlighted fragments per result (default: %(default)s)")
+    parser.add_argument("-b", "--bulk", dest="bulk", action="store_true",
+                        help="use bulk API for --add and --update")
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int, default=BULK_CHUNK_SIZE,
+                        help="number of documents in one bulk request (default: %(default)s)")
+    parser.add_argument("--max-chunk-bytes", dest="max_chunk_bytes", type=int, default=BULK_MAX_CHUNK_BYTES,
+                        help="max size of one bulk request in bytes (default: %(default)s)")
+    parser.add_argument("--bulk-threads", dest="bulk_threads", type=int, default=1,
+                        help="number of threads sending bulk requests in parallel (default: %(default)s)")
+    parser.add_argument("--scroll-size", dest="scroll_size", type=int, default=SCROLL_SIZE,
+                        help="number of documents in one scroll page for --cleanup (default: %(default)s)")
+    parser.add_argument("--split-size", dest="split_size", type=int, default=SPLIT_SIZE,
+                        help="files bigger than this (bytes) are indexed by parts, 0 - never split (default: %(default)s)")
+    parser.add_argument("--hash", dest="hash_name", choices=HASHES, default=HASH,
+                        help="content hash, after changing it run --update with --no-manifest once to index "
+                             "all files with new hash (default: %(default)s)")
+    parser.add_argument("--manifest", dest="manifest", default=MANIFEST,
+                        help="local cache of indexed files, unchanged files are skipped (default: %(default)s)")
+    parser.add_argument("--no-manifest", dest="no_manifest", action="store_true",
+                        help="don't use local cache of indexed files, read every file")
+    parser.add_argument("--async", dest="async_", action="store_true",
+                        help="run --add, --update, --cleanup and --search with concurrent requests, "
+                             "for high latency links; needs elasticsearch[async] >= 7.8")
+    parser.add_argument("--concurrency", dest="concurrency", type=int, default=CONCURRENCY,
+                        help="max number of requests in flight with --async (default: %(default)s)")
     args = parser.parse_args()
+    index_args = {
+        'bulk': args.bulk,
+        'chunk_size': args.chunk_size,
+        'max_chunk_bytes': args.max_chunk_bytes,
+        'threads': args.bulk_threads,
+        'workers': args.jobs,
+        'queue_depth': args.queue_depth,
+        'processes': args.processes
+    }
+
+    manifest = None
+    if not args.no_manifest:
+        manifest = Manifest(args.manifest)
+        atexit.register(manifest.close)
+
+    if args.async_ and (args.add or args.update or args.cleanup or args.search):
+        if AsyncElasticsearch is None:
+            print('error: --async needs elasticsearch[async] >= 7.8')
+            sys.exit(1)
+        docs = AsyncElasticData(elastic_hosts=ELASTIC_HOSTS, index=INDEX, type=TYPE, map=MAP, manifest=manifest,
+                                split_size=args.split_size, hash_name=args.hash_name,
+                                partition_depth=args.partition_depth, shards=args.shards, replicas=args.replicas,
+                                concurrency=args.concurrency)
+        asyncio.run(run_async(docs, args, index_args))
+        sys.exit(0)
+
+    if args.migrate and args.partition_depth < 1:
+        print('error: --migrate needs --partition-depth')
+        sys.exit(1)
+
+    docs = ElasticData(elastic_hosts=ELASTIC_HOSTS, index=INDEX, type=TYPE, map=MAP, manifest=manifest,
+                       split_size=args.split_size, hash_name=args.hash_name,
+                       partition_depth=0 if args.migrate else args.partition_depth, shards=args.shards,
+                       replicas=args.replicas)
+    docs.connect(create=not args.migrate)
+    if not docs.is_connected():
+        print('error: can\'t establish connection to Elastic')
+        sys.exit(1)
+
+    if (args.add or args.update or args.watch or args.migrate) and not docs.rekeyed:
+        print('error: {} has documents indexed by older version, run --rekey first'.format(INDEX))
+        sys.exit(1)
 
     if len(sys.argv) == 1:
         info = docs.update_info()
         print('docs count: {}, store size: {}'.format(info['docs.count'], info['store.size']))
 
     if args.list:
-        all_docs = docs.list(fields=['path', 'mdate'])
+        all_docs = docs.list(fields=['path', 'mdate'], parts=False)
         for doc in all_docs:
             date = datetime.datetime.fromtimestamp(int(doc['_source']['mdate'])).strftime('%Y-%m-%d %H:%M:%S')
             print('{} ({})'.format(doc['_source']['path'], date))
         sys.exit(0)
 
     if args.search:
-        docs.search(args.search)
+        print_hits(docs.search(args.search, path=args.path, size=args.size, from_=args.from_,
+                               fragment_size=args.fragment_size, number_of_fragments=args.fragments))
         sys.exit(0)
 
     if args.update:
-        docs.update()
+        with docs.bulk_load() if args.bulk_load else contextlib.nullcontext():
+            docs.update(**index_args)
         sys.exit(0)
 
     if args.cleanup:
-        docs.cleanup()
+        print('deleted: ', docs.cleanup(chunk_size=args.chunk_size, max_chunk_bytes=args.max_chunk_bytes,
+                                        threads=args.bulk_threads, scroll_size=args.scroll_size))
+        sys.exit(0)
+
+    if args.rekey:
+        print('moved: ', docs.rekey(chunk_size=args.chunk_size, max_chunk_bytes=args.max_chunk_bytes,
+                                    threads=args.bulk_threads))
+        sys.exit(0)
+
+    if args.count:
+        print('files: ', docs.count_by_path(path=args.count))
+        sys.exit(0)
+
+    if args.migrate:
+        moved = docs.migrate(args.partition_depth, chunk_size=args.chunk_size,
+                             max_chunk_bytes=args.max_chunk_bytes, threads=args.bulk_threads)
+        if moved is None:
+            sys.exit(1)
+        print('moved: ', moved)
+        sys.exit(0)
+
+    if args.upgrade:
+        print('updated: ', docs.upgrade()['updated'])
         sys.exit(0)
 
     if args.add:
-        docs.import_docs(paths=args.add)
+        with docs.bulk_load() if args.bulk_load else contextlib.nullcontext():
+            docs.import_docs(paths=args.add, text_ext=args.text_ext, skip_ext=args.skip_ext,
+                             min_size=args.min_size, max_size=args.max_size, **index_args)
         sys.exit(0)
 
+    if args.watch:
+        watcher = Watcher(docs, args.watch, debounce=args.debounce, poll_interval=args.poll_interval,
+                          text_ext=args.text_ext, skip_ext=args.skip_ext, min_size=args.min_size,
+                          max_size=args.max_size, index_args=dict(index_args, bulk=True))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            sys.exit(0)
+
     if args.delete:
         print('deleted: ', docs.delete_by_path(path=args.delete)['deleted'])
         sys.exit(0)
 
     if args.get:
         doc = docs.find_by_path(path=args.get)
-        if doc:
+        if doc and 'parts' in doc['_source']:
+            for content in docs.get_parts(doc):
+                print(content, end='')
+            print()
+        elif doc:
             print(doc['_source']['content'])
         else:
             print('not found')
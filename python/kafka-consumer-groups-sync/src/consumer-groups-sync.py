@@ -3,6 +3,8 @@
 from kafka import KafkaConsumer, KafkaAdminClient, TopicPartition
 from kafka.structs import OffsetAndMetadata
 from kafka.cluster import ClusterMetadata
+from kafka.errors import NotCoordinatorForGroupError, GroupCoordinatorNotAvailableError
+from prometheus_client import Gauge, generate_latest, CONTENT_TYPE_LATEST
 import argparse
 import logging
 import time
@@ -11,13 +13,20 @@ import sys
 import yaml
 import signal
 import threading
+import copy
 from http.server import HTTPServer, SimpleHTTPRequestHandler
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # Prevent generating unneeded logs from python kafka module
 log_kafka = logging.getLogger('kafka')
 log_kafka.setLevel(logging.ERROR)
 
+# Prometheus metrics
+FETCH_DURATION = Gauge("consumer_groups_sync_fetch_duration",
+    "Time spent fetching offsets of all consumer groups from cluster in last sync (seconds)", ["cluster"])
+GROUPS = Gauge("consumer_groups_sync_groups", "Number of consumer groups on cluster in last sync", ["cluster"])
+
 def get_args():
     parser = argparse.ArgumentParser(description="Sync Kafka consumers group")
     parser.add_argument("-c", "--config", dest="config", 
@@ -25,48 +34,159 @@ def get_args():
     return parser.parse_args() 
 
 class ConsumerGroups(object):
-    def __init__(self, bootstrap_servers):
+    def __init__(self, bootstrap_servers, name, fetch_workers=8, coordinator_ttl=300):
         self.bootstrap_servers = bootstrap_servers
+        self.name = name
+        self.coordinator_ttl = coordinator_ttl
         self.admin = KafkaAdminClient(bootstrap_servers=bootstrap_servers)
+        # Admin client isn't thread safe, each worker has its own
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=fetch_workers)
+        # group -> node_id of its coordinator
+        self.coordinators = {}
+        self.coordinators_time = 0
 
     def get_groups(self):
+        fetch_start = time.time()
+        group_ids = [group[0] for group in self.admin.list_consumer_groups()]
+        coordinators = self.get_coordinators(group_ids)
+        # Offsets of groups are fetched by workers at once, each group from its known coordinator
+        futures = {group_id: self.executor.submit(self.get_offsets, group_id, coordinators[group_id])
+                   for group_id in group_ids}
         # tp - topic->partitions
-        tp = {}
-        for group in self.admin.list_consumer_groups():
-            tp[group[0]] = self.admin.list_consumer_group_offsets(group_id=group[0])
+        tp = {group_id: future.result() for group_id, future in futures.items()}
+        FETCH_DURATION.labels(self.name).set(time.time() - fetch_start)
+        GROUPS.labels(self.name).set(len(tp))
+        logging.debug(f"Offsets of {len(tp)} groups fetched from {self.name} in {time.time() - fetch_start:.1f}s")
         return tp
 
+    # Coordinators of groups, looked up once for new groups and all groups again after coordinator_ttl
+    def get_coordinators(self, group_ids):
+        if time.time() - self.coordinators_time >= self.coordinator_ttl:
+            self.coordinators = {}
+            self.coordinators_time = time.time()
+        new_groups = [group_id for group_id in group_ids if group_id not in self.coordinators]
+        if new_groups:
+            # One FindCoordinator request per group, all of them sent before waiting for responses
+            self.coordinators.update(self.admin._find_coordinator_ids(new_groups))
+        return {group_id: self.coordinators[group_id] for group_id in group_ids}
+
+    # States of groups (Empty, Stable, ...), described per coordinator
+    def get_states(self, group_ids):
+        grps_by_coordinator = {}
+        for group_id, coordinator_id in self.get_coordinators(group_ids).items():
+            grps_by_coordinator.setdefault(coordinator_id, []).append(group_id)
+        states = {}
+        for coordinator_id, coordinator_grps in grps_by_coordinator.items():
+            for group in self.admin.describe_consumer_groups(coordinator_grps, group_coordinator_id=coordinator_id):
+                states[group.group] = group.state
+        return states
+
+    # Runs in worker thread
+    def get_offsets(self, group_id, coordinator_id):
+        if not hasattr(self.local, "admin"):
+            self.local.admin = KafkaAdminClient(bootstrap_servers=self.bootstrap_servers)
+        try:
+            return self.local.admin.list_consumer_group_offsets(group_id=group_id,
+                                                                group_coordinator_id=coordinator_id)
+        except (NotCoordinatorForGroupError, GroupCoordinatorNotAvailableError):
+            # Coordinator moved, admin client looks it up, next sync looks it up again
+            logging.debug(f"Coordinator of {group_id} on {self.name} moved")
+            self.coordinators.pop(group_id, None)
+            return self.local.admin.list_consumer_group_offsets(group_id=group_id)
+
 class SyncConsumerGroups(object):
-    def __init__(self, src_grps, dst_grps):
+    def __init__(self, src_grps, dst_grps, offset_threshold=0):
         self.src_grps = src_grps
         self.dst_grps = dst_grps
+        self.offset_threshold = offset_threshold
+        # group -> offsets committed to destination by previous syncs
+        self.synced = {}
 
     def sync(self):
         src_grps = self.src_grps.get_groups()
         dst_grps = self.dst_grps.get_groups()
+        # group -> partitions to commit for groups existing on destination
+        grps_changes = {}
         for group_id in src_grps.keys():
             logging.debug(f"Processing {group_id}")
             if len(src_grps[group_id].keys()) == 0:
                 logging.debug(f"Number of partitions is 0 for {group_id}, skipping")
             elif group_id not in dst_grps:
-                consumer = KafkaConsumer(group_id=group_id, auto_offset_reset='earliest',
-                                          bootstrap_servers=self.dst_grps.bootstrap_servers, 
-                                          enable_auto_commit=True)
-                # TODO: add handling case when number of topic partitions is different
-                consumer.commit(src_grps[group_id])
-                logging.info(f"Group {group_id} created")
-            elif len(src_grps[group_id].keys()) != len(dst_grps[group_id].keys()):
-                # TODO: need to handle this
-                logging.warning(f"Number of partitions is different")
+                if self.commit(group_id, src_grps[group_id]):
+                    self.synced[group_id] = dict(src_grps[group_id])
+                    logging.info(f"Group {group_id} created")
             else:
-                logging.debug(f"Group {group_id} is already in sync, no action needed")
+                changes = self.changes(group_id, src_grps[group_id], dst_grps[group_id])
+                if changes:
+                    grps_changes[group_id] = changes
+                else:
+                    logging.debug(f"Group {group_id} is already in sync, no action needed")
             logging.debug(f"Processing {group_id} finished")
 
+        # Group with members on destination rejects commits of others
+        states = self.dst_grps.get_states(list(grps_changes)) if grps_changes else {}
+        for group_id, changes in grps_changes.items():
+            if states.get(group_id) != "Empty":
+                logging.info(f"Group {group_id} is {states.get(group_id)} on destination, not synced")
+            elif self.commit(group_id, changes):
+                self.synced[group_id].update(changes)
+                logging.info(f"Group {group_id} synced, {len(changes)} partitions")
+        self.synced = {group_id: offsets for group_id, offsets in self.synced.items() if group_id in src_grps}
+
+    # Partitions of group with offset moved on source more than offset_threshold since previous sync,
+    # or not committed on destination yet. Partitions committed on destination by others
+    # (consumers already work with destination) are left as is
+    def changes(self, group_id, src_offsets, dst_offsets):
+        if group_id not in self.synced:
+            # Group found on destination after start: offsets not ahead of source are taken as committed
+            # by previous syncs, offsets ahead of source (None) are committed by consumers on destination.
+            # Offsets changed on destination after they are seen are taken as foreign too
+            self.synced[group_id] = {tp: dst_offset if tp in src_offsets and
+                                     dst_offset.offset <= src_offsets[tp].offset else None
+                                     for tp, dst_offset in dst_offsets.items()}
+        synced = self.synced[group_id]
+        changes = {}
+        moved = []
+        for tp, src_offset in src_offsets.items():
+            if tp not in synced or tp not in dst_offsets:
+                changes[tp] = src_offset
+            elif synced[tp] is None or dst_offsets[tp].offset != synced[tp].offset:
+                moved.append(tp)
+            elif abs(src_offset.offset - synced[tp].offset) > self.offset_threshold:
+                changes[tp] = src_offset
+        if moved:
+            logging.warning(f"Group {group_id} offsets of {len(moved)} partitions changed on destination, "
+                            "not synced")
+        return changes
+
+    # Returns False if commit failed, the group is tried again in next sync
+    def commit(self, group_id, offsets):
+        try:
+            consumer = KafkaConsumer(group_id=group_id, auto_offset_reset='earliest',
+                                      bootstrap_servers=self.dst_grps.bootstrap_servers, 
+                                      enable_auto_commit=True)
+            try:
+                consumer.commit(offsets)
+            finally:
+                consumer.close(autocommit=False)
+        except Exception as e:
+            logging.error(f"Commit of {group_id} offsets failed: {e}")
+            return False
+        return True
+
 class MainApp(object):
+    DEFAULT_CONFIG = {
+        "fetch_workers": 8,
+        "coordinator_ttl": 300,
+        "offset_threshold": 0
+    }
+
     def __init__(self, conf):
+        self.conf = copy.copy(self.DEFAULT_CONFIG)
         try:
             with open(conf, "r") as config_f:
-                self.conf = yaml.safe_load(config_f)
+                self.conf.update(yaml.safe_load(config_f))
         except Exception as e:
             print(f"FATAL: wrong format of config file: {e}")
             sys.exit(1)
@@ -101,14 +221,19 @@ class MainApp(object):
             sys.exit(0)
 
     def main(self):
-        src_grps = ConsumerGroups(self.conf["source"]["bootstrap_servers"])
-        dst_grps = ConsumerGroups(self.conf["destination"]["bootstrap_servers"])
-        sync = SyncConsumerGroups(src_grps, dst_grps)
+        src_grps = ConsumerGroups(self.conf["source"]["bootstrap_servers"], "source",
+                                  self.conf["fetch_workers"], self.conf["coordinator_ttl"])
+        dst_grps = ConsumerGroups(self.conf["destination"]["bootstrap_servers"], "destination",
+                                  self.conf["fetch_workers"], self.conf["coordinator_ttl"])
+        sync = SyncConsumerGroups(src_grps, dst_grps, self.conf["offset_threshold"])
         while True:
             self.watch_dog = int(time.time())
             logging.info("Sync started")
-            sync.sync()
-            logging.info("Sync finished")
+            try:
+                sync.sync()
+                logging.info("Sync finished")
+            except Exception as e:
+                logging.error(f"Sync failed: {e}")
             logging.info(f"Sleep for {self.conf['interval']}s")
             time.sleep(self.conf['interval'])
 
@@ -116,6 +241,13 @@ class MainApp(object):
         class HealthCheckHandler(SimpleHTTPRequestHandler):
             _main = self
             def do_GET(self_):
+                if self_.path == "/metrics":
+                    payload = generate_latest()
+                    self_.send_response(200)
+                    self_.send_header("Content-Type", CONTENT_TYPE_LATEST)
+                    self_.end_headers()
+                    self_.wfile.write(payload)
+                    return
                 cur_ts = int(time.time())
                 if (cur_ts - self_._main.watch_dog) < self_._main.max_watch_dog_diff:
                     self_.send_response(200)
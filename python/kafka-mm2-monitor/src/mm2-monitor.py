@@ -4,8 +4,8 @@ from kafka import KafkaConsumer, KafkaAdminClient, TopicPartition
 from kafka.structs import OffsetAndMetadata
 from kafka.cluster import ClusterMetadata
 from urllib.parse import quote_plus, parse_qs, urlparse
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from prometheus_client import start_http_server, Summary, Counter, Gauge, MetricsHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from prometheus_client import start_http_server, Summary, Counter, Gauge, generate_latest, CONTENT_TYPE_LATEST
 import argparse
 import logging
 import time
@@ -17,39 +17,112 @@ import threading
 import re
 import json
 import copy
+import hashlib
+import math
+import multiprocessing
+import pickle
+from array import array
+from collections import deque
+from queue import Empty
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait
 
 # Prevent generating unneeded logs from python kafka module
 log_kafka = logging.getLogger("kafka")
 log_kafka.setLevel(logging.ERROR)
 
 # Prometheus metrics
-TOPICS = Gauge("mm2_monitor_topics", "Number of topics from source under monitoring", ["mm_instance"])
-ITER_DURATION = Gauge("mm2_monitor_iter_duration", "Time spent in last loop iteration (seconds)", ["mm_instance"])
-ITER_START = Gauge("mm2_monitor_iter_start", "Time last loop iteration started (timestamp)", ["mm_instance"])
-ITER_FAILED = Counter("mm2_monitor_iter_failed_total", "Number of failed loop iterations", ["mm_instance"])
-ITER_LAST_SUCCESS = Gauge("mm2_monitor_iter_last_success", "Time of last successful loop iteration (timestamp)", ["mm_instance"])
-ITER_LAST_STATUS = Gauge("mm2_monitor_iter_last_status", "Status of last loop iteration (0 - failed, 1 success)", ["mm_instance"])
+TOPICS = Gauge("mm2_monitor_topics", "Number of topics from source under monitoring", ["mm_instance", "shard"])
+ITER_DURATION = Gauge("mm2_monitor_iter_duration", "Time spent in last loop iteration (seconds)", ["mm_instance", "shard"])
+ITER_START = Gauge("mm2_monitor_iter_start", "Time last loop iteration started (timestamp)", ["mm_instance", "shard"])
+ITER_FAILED = Counter("mm2_monitor_iter_failed_total", "Number of failed loop iterations", ["mm_instance", "shard"])
+ITER_LAST_SUCCESS = Gauge("mm2_monitor_iter_last_success", "Time of last successful loop iteration (timestamp)", ["mm_instance", "shard"])
+ITER_LAST_STATUS = Gauge("mm2_monitor_iter_last_status", "Status of last loop iteration (0 - failed, 1 success)", ["mm_instance", "shard"])
 NUMBER_OF_PERIOD_DIFF_TOPICS = Gauge("mm2_monitor_number_of_period_diff_topics", 
-    "Number of topics with different number of messages for particular period of time in the past", ["mm_instance"])
+    "Number of topics with different number of messages for particular period of time in the past", ["mm_instance", "shard"])
 NUMBER_OF_LAG_TOPICS = Gauge("mm2_monitor_number_of_lag_topics", 
-    "Number of topics with lag more the lag_threshold parameter in config", ["mm_instance"])
+    "Number of topics with lag more the lag_threshold parameter in config", ["mm_instance", "shard"])
+TOPICS_CHECKED = Gauge("mm2_monitor_topics_checked", "Number of topics checked in last loop iteration",
+    ["mm_instance", "shard"])
+COVERAGE_LAG = Gauge("mm2_monitor_coverage_lag",
+    "Time since the least recently checked topic was checked (seconds)", ["mm_instance", "shard"])
+ITER_OVERRUN = Gauge("mm2_monitor_iter_overrun",
+    "Time last loop iteration ran over iter_deadline (seconds), 0 if it finished in time", ["mm_instance", "shard"])
+CLUSTER_COLLECT_DURATION = Gauge("mm2_monitor_cluster_collect_duration",
+    "Time spent collecting offsets from cluster in last loop iteration (seconds)", ["mm_instance", "shard", "cluster"])
+TOPIC_LAG = Gauge("mm2_monitor_topic_lag",
+    "Lag of topic on target cluster (messages), only topics selected by topic_metrics_top/topic_metrics_threshold",
+    ["mm_instance", "topic"])
+TOPIC_PERIOD_DIFF = Gauge("mm2_monitor_topic_period_diff",
+    "Difference of number of messages in topic on source and target for period of time in the past, "
+    "only topics selected by topic_metrics_top/topic_metrics_threshold", ["mm_instance", "topic"])
+PARTITION_LAG = Gauge("mm2_monitor_partition_lag",
+    "Lag of partition on target cluster (messages), only partitions of topics exported to mm2_monitor_topic_lag "
+    "if partition_metrics is enabled", ["mm_instance", "topic", "partition"])
+
+# Up to top values with absolute value bigger than threshold
+def select_top(values, top, threshold):
+    selected = sorted((item for item in values.items() if abs(item[1]) > threshold),
+                      key=lambda item: abs(item[1]), reverse=True)
+    return dict(selected[:top])
+
+# Sets gauge for label sets of one iteration, label sets not set anymore are removed
+class LabeledGauge(object):
+    def __init__(self, gauge, instance):
+        self.gauge = gauge
+        self.instance = instance
+        self.labels = set()
+
+    def set(self, values):
+        for labels, value in values.items():
+            self.gauge.labels(self.instance, *labels).set(value)
+        for labels in self.labels - values.keys():
+            self.gauge.remove(self.instance, *labels)
+        self.labels = set(values)
+
+# Jump consistent hash of topic name to one of shards, when number of shards changes
+# only topics of added/removed shards move
+def topic_shard(topic, shards):
+    key = int.from_bytes(hashlib.md5(topic.encode("utf-8")).digest()[:8], "big")
+    shard, j = -1, 0
+    while j < shards:
+        shard = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((shard + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return shard
 
 def get_args():
     parser = argparse.ArgumentParser(description="Sync Kafka consumers group")
     parser.add_argument("-c", "--config", dest="config", 
                         help="config file, yaml format", default="config.yaml")
+    parser.add_argument("-s", "--shard", dest="shard", type=int,
+                        help="monitor only this shard of topics out of shards in config, overrides shard in config")
     return parser.parse_args() 
 
 class Topics(object):
-    def __init__(self, bservers, group_id, topics_bl=None, topics=None):
+    def __init__(self, bservers, group_id, topics_bl=None, topics=None, shard=0, shards=1):
         self.bservers = bservers
         self.group_id = group_id
-        self.topics_bl = topics_bl
+        self.topics_bl = [re.compile(regexp) for regexp in topics_bl] if topics_bl else None
         self.topics = topics
+        self.shard = shard
+        self.shards = shards
+        self.consumer = None
 
     def get(self):
-        topics = KafkaConsumer(group_id=self.group_id, bootstrap_servers=self.bservers).topics()
+        topics = self.get_all()
+        if self.shards > 1:
+            topics = [topic for topic in topics if topic_shard(topic, self.shards) == self.shard]
+        return topics
+
+    def get_all(self):
+        if self.consumer is None:
+            self.consumer = KafkaConsumer(group_id=self.group_id, bootstrap_servers=self.bservers)
+        try:
+            topics = self.consumer.topics()
+        except Exception:
+            self.close()
+            raise
         if self.topics:
             # Only topics from the list
             topics_ = []
@@ -65,7 +138,7 @@ class Topics(object):
                 topics_ = []
                 for topic in topics:
                     for regexp in self.topics_bl:
-                        if re.search(regexp, topic):
+                        if regexp.search(topic):
                             break
                     else:
                         topics_.append(topic)
@@ -73,19 +146,174 @@ class Topics(object):
             else:
                 return topics
 
+    def close(self):
+        if self.consumer is not None:
+            self.consumer.close()
+            self.consumer = None
+
+# Offsets of partitions at timestamps sampled every step seconds per topic, start of monitor_period is taken
+# from the sample at or before it instead of searching time index of old segments on every iteration. Samples
+# are taken with the same timestamp on both clusters, so period of topic is the same on source and target
+class OffsetHistory(object):
+    def __init__(self, period, step, path=None):
+        self.period = period * 1000
+        self.step = step * 1000
+        self.path = path
+        # (timestamp, {cluster: (partitions, offsets)}), oldest first, with topics due for sampling only
+        self.samples = deque()
+        # topic -> timestamp of its last sample
+        self.sampled = {}
+        if self.path:
+            self.load()
+
+    # Offsets per cluster for start of period from the newest sample of partition not newer than ts_start,
+    # only partitions sampled on all clusters, other partitions are looked up by timestamp
+    def start_offsets(self, ts_start, clusters):
+        result = {cl_name: {} for cl_name in clusters}
+        for ts, sample in reversed(self.samples):
+            if ts > ts_start or any(cl_name not in sample for cl_name in clusters):
+                continue
+            offsets = {cl_name: dict(zip(*sample[cl_name])) for cl_name in clusters}
+            common = set.intersection(*(set(cl_offsets) for cl_offsets in offsets.values()))
+            for cl_name, cl_offsets in offsets.items():
+                for tp in common:
+                    result[cl_name].setdefault(tp, cl_offsets[tp])
+        return result
+
+    # offsets is {cluster: (partitions, offsets)}, samples older than needed for ts_start are dropped
+    def add(self, ts, offsets, ts_start):
+        topics = {tp.topic for tps, _ in offsets.values() for tp in tps}
+        due = {topic for topic in topics if ts - self.sampled.get(topic, 0) >= self.step}
+        if not due:
+            return
+        last = self.samples[-1][1] if self.samples else {}
+        sample = {}
+        for cl_name, (tps, cl_offsets) in offsets.items():
+            if len(due) < len(topics):
+                due_idx = [i for i, tp in enumerate(tps) if tp.topic in due]
+                tps = [tps[i] for i in due_idx]
+                cl_offsets = array("q", [cl_offsets[i] for i in due_idx])
+            # The same partitions in most samples, list is shared
+            if cl_name in last and last[cl_name][0] == tps:
+                tps = last[cl_name][0]
+            sample[cl_name] = (tps, cl_offsets)
+        self.samples.append((ts, sample))
+        for topic in due:
+            self.sampled[topic] = ts
+
+        # Topics are sampled every step or a bit later, when they are checked
+        min_ts = ts_start - 2 * self.step
+        while self.samples and self.samples[0][0] < min_ts:
+            self.samples.popleft()
+        self.sampled = {topic: ts for topic, ts in self.sampled.items() if ts >= min_ts}
+        if self.path:
+            self.save()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as history_f:
+                history = pickle.load(history_f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logging.warning(f"offsets history {self.path} is not loaded: {e}")
+            return
+        if history["step"] != self.step:
+            logging.warning(f"offsets history {self.path} was sampled with other step, not loaded")
+            return
+        self.samples = deque(history["samples"])
+        for ts, sample in self.samples:
+            for tps, _ in sample.values():
+                self.sampled.update((tp.topic, ts) for tp in tps)
+        logging.info(f"Loaded {len(self.samples)} samples of offsets history from {self.path}")
+
+    def save(self):
+        try:
+            with open(self.path + ".tmp", "wb") as history_f:
+                pickle.dump({"step": self.step, "samples": list(self.samples)}, history_f,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(self.path + ".tmp", self.path)
+        except Exception as e:
+            logging.error(f"saving offsets history to {self.path} failed: {e}")
+
+# Offsets of partitions of one cluster in parallel arrays, partitions of topic are consecutive.
+# Partitions without messages since start of period have -1 offset_start/offset_stop and 0 diffs
+class ClusterOffsets(object):
+    __slots__ = ["tps", "topics", "offset_start", "offset_stop", "offset_latest", "diff_period", "diff_end"]
+
+    def __init__(self, tps, offset_start, offset_stop, offset_latest):
+        self.tps = tps
+        # topic -> (first, last + 1) index of its partitions
+        self.topics = {}
+        for i, tp in enumerate(tps):
+            first = self.topics[tp.topic][0] if tp.topic in self.topics else i
+            self.topics[tp.topic] = (first, i + 1)
+        self.offset_start = array("q", offset_start)
+        self.offset_stop = array("q", offset_stop)
+        self.offset_latest = array("q", offset_latest)
+        self.diff_period = array("q", [stop - start if start >= 0 else 0
+                                       for start, stop in zip(self.offset_start, self.offset_stop)])
+        self.diff_end = array("q", [latest - start if start >= 0 else 0
+                                    for start, latest in zip(self.offset_start, self.offset_latest)])
+
+    def range(self, topic):
+        return self.topics.get(topic, (0, 0))
+
+    def totals(self, topic):
+        first, last = self.range(topic)
+        return sum(self.diff_period[first:last]), sum(self.diff_end[first:last])
+
+    # Offsets of topic in format of debug output
+    def topic_dict(self, topic):
+        first, last = self.range(topic)
+        partitions = {}
+        for i in range(first, last):
+            p_stats = {
+                "offset_start": None,
+                "offset_stop": None,
+                "offset_latest": self.offset_latest[i]
+            }
+            if self.offset_start[i] >= 0:
+                p_stats["offset_start"] = self.offset_start[i]
+                p_stats["offset_stop"] = self.offset_stop[i]
+                p_stats["diff_period"] = self.diff_period[i]
+                p_stats["diff_end"] = self.diff_end[i]
+            partitions[self.tps[i].partition] = p_stats
+        diff_period_total, diff_end_total = self.totals(topic)
+        return {
+            "partitions": partitions,
+            "diff_period_total": diff_period_total,
+            "diff_end_total": diff_end_total
+        }
+
 class TopicsStats(object):
     def __init__(self, source, target, monitor_period, monitor_shift,
-                 lag_threshold, group_id):
+                 lag_threshold, group_id, metadata_ttl=300, history_step=300, history_file=None):
         self.source = source
         self.target = target
         self.monitor_period = monitor_period
         self.monitor_shift = monitor_shift
         self.group_id = group_id
         self.lag_threshold = lag_threshold
+        self.metadata_ttl = metadata_ttl
+        # Long-lived consumer and thread per cluster
+        self.consumers = {}
+        # Partitions of monitored topics per cluster
+        self.partitions_cache = {}
+        # Time spent collecting offsets from cluster in last iteration
+        self.cluster_durations = {}
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # Topics and ClusterOffsets per cluster of last iteration
+        self.topics = []
+        self.result = {}
+        self.history = OffsetHistory(monitor_period, history_step, history_file)
 
         self.metrics = {
             "number_of_lag_topics": None,
-            "number_of_period_diff_topics": None
+            "number_of_period_diff_topics": None,
+            "topic_lag": {},
+            "topic_period_diff": {},
+            "partition_lag": {}
         }
 
     def collect(self, topics):
@@ -93,67 +321,153 @@ class TopicsStats(object):
             self.source["name"]: self.source["bservers"],
             self.target["name"]: self.target["bservers"]
         }
-        clusters_con = {}
-        for cl_name, cl_bservers in clusters.items():
-            clusters_con[cl_name] = KafkaConsumer(
-                group_id=self.group_id, bootstrap_servers=cl_bservers)
 
+        # Both clusters are queried at the same time for the same timestamps
         ts_cur = int(time.time()*1000)
         ts_start = ts_cur - self.monitor_period * 1000
         ts_stop = ts_cur - self.monitor_shift  * 1000
 
+        start_offsets = self.history.start_offsets(ts_start, clusters)
+
+        futures = {}
+        for cl_name, cl_bservers in clusters.items():
+            futures[cl_name] = self.executor.submit(self.collect_cluster, cl_name, cl_bservers,
+                                                    topics, ts_start, ts_stop, start_offsets[cl_name])
+        # Both finish before an exception is raised, so consumer of a cluster is never used by two threads
+        wait(futures.values())
         result = {}
-        for topic in topics:
-            logging.debug(f"Processing topic {topic}")
-            result[topic] = {}
-            for cl_name, cl_consumer in clusters_con.items():
-                result[topic][cl_name] = {}
-                result[topic][cl_name]["partitions"] = {}
-                result[topic][cl_name]["diff_period_total"] = 0
-                result[topic][cl_name]["diff_end_total"] = 0
-                partitions = cl_consumer.partitions_for_topic(topic)
-                p_end_offsets = cl_consumer.end_offsets([TopicPartition(topic, p) for p in partitions])
-
-                for p in partitions:
-                    result[topic][cl_name]["partitions"][p] = {
-                        "offset_start": None,
-                        "offset_stop": None,
-                        "offset_latest": None
-                    }
-                    tp = TopicPartition(topic, p)
-                    result[topic][cl_name]["partitions"][p]["offset_latest"] = p_end_offsets[tp]
-                    offset_start = cl_consumer.offsets_for_times({tp: ts_start})[tp]
-                    if offset_start:
-                        result[topic][cl_name]["partitions"][p]["offset_start"] = offset_start.offset
-                        offset_stop = cl_consumer.offsets_for_times({tp: ts_stop})[tp]
-                        if offset_stop:
-                            result[topic][cl_name]["partitions"][p]["offset_stop"] = offset_stop.offset
-                        else:
-                            # Get the latest offset
-                            offset_stop = p_end_offsets[tp]-1
-                            result[topic][cl_name]["partitions"][p]["offset_stop"] = offset_stop
-                        result[topic][cl_name]["partitions"][p]["diff_period"] = result[topic][cl_name]["partitions"][p]["offset_stop"] - \
-                            result[topic][cl_name]["partitions"][p]["offset_start"]
-                        result[topic][cl_name]["partitions"][p]["diff_end"] = result[topic][cl_name]["partitions"][p]["offset_latest"] - \
-                            result[topic][cl_name]["partitions"][p]["offset_start"]
-                        result[topic][cl_name]["diff_period_total"] += result[topic][cl_name]["partitions"][p]["diff_period"]
-                        result[topic][cl_name]["diff_end_total"] += result[topic][cl_name]["partitions"][p]["diff_end"]
+        samples = {}
+        for cl_name, future in futures.items():
+            result[cl_name], samples[cl_name] = future.result()
+        self.history.add(ts_stop, self.consistent_samples(samples), ts_start)
+
+        self.topics = topics
         self.result = result
         self.calc_metrics()
         return self.metrics
 
+    # Sample of partition with message after ts_stop on one cluster but not yet on other (replication lag)
+    # is end offset there, behind the offset at ts_stop, and would give false period diff when it's start
+    # of period later; such partitions aren't sampled and are looked up by timestamp until next sample
+    def consistent_samples(self, samples):
+        fallbacks = {}
+        for tps, _, fallback in samples.values():
+            for tp in tps:
+                fallbacks.setdefault(tp, set()).add(tp in fallback)
+        lagging = {tp for tp, values in fallbacks.items() if len(values) > 1}
+        result = {}
+        for cl_name, (tps, sample, _) in samples.items():
+            if lagging:
+                idx = [i for i, tp in enumerate(tps) if tp not in lagging]
+                tps = [tps[i] for i in idx]
+                sample = array("q", [sample[i] for i in idx])
+            result[cl_name] = (tps, sample)
+        return result
+
+    def consumer(self, cl_name, cl_bservers):
+        if cl_name not in self.consumers:
+            self.consumers[cl_name] = KafkaConsumer(group_id=self.group_id, bootstrap_servers=cl_bservers)
+        return self.consumers[cl_name]
+
+    # Runs in thread pool, one task per cluster at once
+    def collect_cluster(self, cl_name, cl_bservers, topics, ts_start, ts_stop, start_offsets):
+        collect_start = time.time()
+        try:
+            result = self.collect_offsets(cl_name, self.consumer(cl_name, cl_bservers), topics,
+                                          ts_start, ts_stop, start_offsets)
+        except Exception:
+            # Next iteration starts with new connection and metadata
+            cl_consumer = self.consumers.pop(cl_name, None)
+            if cl_consumer is not None:
+                cl_consumer.close()
+            self.partitions_cache.pop(cl_name, None)
+            raise
+        finally:
+            self.cluster_durations[cl_name] = time.time() - collect_start
+        return result
+
+    # Returns offsets of topics and sample of offsets at ts_stop for the history with partitions
+    # which have no message after ts_stop yet
+    def collect_offsets(self, cl_name, cl_consumer, topics, ts_start, ts_stop, start_offsets):
+        # One request per broker for all partitions of all topics, instead of per partition
+        tps = self.topic_partitions(cl_name, cl_consumer, topics)
+        logging.debug(f"Getting offsets of {len(tps)} partitions from {cl_name}")
+        end_offsets = cl_consumer.end_offsets(tps)
+        offsets_start = {tp: start_offsets[tp] for tp in tps if tp in start_offsets}
+        # Partitions not in history yet (after start or new ones) are looked up by timestamp
+        backfill = [tp for tp in tps if tp not in start_offsets]
+        if backfill:
+            logging.debug(f"Looking up start offsets of {len(backfill)} partitions on {cl_name} by timestamp")
+            for tp, offset in cl_consumer.offsets_for_times({tp: ts_start for tp in backfill}).items():
+                offsets_start[tp] = offset.offset if offset else None
+        offsets_stop = cl_consumer.offsets_for_times({tp: ts_stop for tp in tps})
+        # No message after ts_stop yet, the next one gets end offset
+        sample = array("q", [offsets_stop[tp].offset if offsets_stop[tp] else end_offsets[tp] for tp in tps])
+
+        offset_start = [-1 if offsets_start[tp] is None else offsets_start[tp] for tp in tps]
+        # Start from history is the next offset after a sampled timestamp, stop is taken the same way,
+        # start looked up by timestamp has message after it and stop is the latest offset without message after ts_stop
+        offset_stop = [-1 if offsets_start[tp] is None else stop if tp in start_offsets
+                       else offsets_stop[tp].offset if offsets_stop[tp] else end_offsets[tp] - 1
+                       for tp, stop in zip(tps, sample)]
+        offset_latest = [end_offsets[tp] for tp in tps]
+        fallback = {tp for tp in tps if not offsets_stop[tp]}
+        return ClusterOffsets(tps, offset_start, offset_stop, offset_latest), (tps, sample, fallback)
+
+    # Number of partitions of topics on source known from metadata cache
+    def partition_counts(self):
+        cached = self.partitions_cache.get(self.source["name"])
+        return {topic: len(tps) for topic, tps in cached["partitions"].items()} if cached else {}
+
+    # Number of partitions on source in last iteration
+    def partitions_checked(self):
+        offsets = self.result.get(self.source["name"])
+        return len(offsets.tps) if offsets else 0
+
+    # Partitions of topics on the cluster, cached per topic and refreshed after metadata_ttl seconds
+    def topic_partitions(self, cl_name, cl_consumer, topics):
+        cached = self.partitions_cache.get(cl_name)
+        if not cached or time.time() - cached["time"] >= self.metadata_ttl:
+            cached = {"time": time.time(), "partitions": {}}
+            self.partitions_cache[cl_name] = cached
+
+        tps = []
+        for topic in topics:
+            if topic not in cached["partitions"]:
+                partitions = cl_consumer.partitions_for_topic(topic)
+                if partitions is None:
+                    logging.warning(f"Topic {topic} doesn't exist on {cl_name}")
+                    partitions = []
+                cached["partitions"][topic] = [TopicPartition(topic, p) for p in sorted(partitions)]
+            tps.extend(cached["partitions"][topic])
+        return tps
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        for cl_consumer in self.consumers.values():
+            cl_consumer.close()
+        self.consumers = {}
+
+    # Offsets of last iteration per topic and cluster
+    def dump(self):
+        return {topic: {cl_name: offsets.topic_dict(topic) for cl_name, offsets in self.result.items()}
+                for topic in self.topics}
+
     def print_result(self):
-        print(json.dumps(self.result, sort_keys=True, indent=4))
+        print(json.dumps(self.dump(), sort_keys=True, indent=4))
 
     def calc_metrics(self):
         self.metrics["number_of_period_diff_topics"] = 0
         self.metrics["number_of_lag_topics"] = 0
+        self.metrics["topic_lag"] = {}
+        self.metrics["topic_period_diff"] = {}
+        self.metrics["partition_lag"] = {}
 
-        for t_name, t_stats in self.result.items():
-            s_diff_period_total = t_stats[self.source["name"]]["diff_period_total"]
-            t_diff_period_total = t_stats[self.target["name"]]["diff_period_total"]
-            s_diff_end_total = t_stats[self.source["name"]]["diff_end_total"]
-            t_diff_end_total = t_stats[self.target["name"]]["diff_end_total"]
+        source = self.result[self.source["name"]]
+        target = self.result[self.target["name"]]
+        for t_name in self.topics:
+            s_diff_period_total, s_diff_end_total = source.totals(t_name)
+            t_diff_period_total, t_diff_end_total = target.totals(t_name)
 
             if s_diff_period_total != t_diff_period_total:
                 self.metrics["number_of_period_diff_topics"] += 1
@@ -163,6 +477,215 @@ class TopicsStats(object):
             if lag > self.lag_threshold:
                 self.metrics["number_of_lag_topics"] += 1
                 logging.warning(f"{t_name} lag is {lag} (>{self.lag_threshold})")
+            self.metrics["topic_lag"][t_name] = lag
+            self.metrics["topic_period_diff"][t_name] = s_diff_period_total - t_diff_period_total
+
+            # MirrorMaker 2 keeps partitions of topic, sorted partitions of both clusters are the same usually
+            s_first, s_last = source.range(t_name)
+            t_first, t_last = target.range(t_name)
+            s_tps = source.tps[s_first:s_last]
+            if s_tps == target.tps[t_first:t_last]:
+                t_diff_end = target.diff_end[t_first:t_last]
+            else:
+                t_index = {target.tps[i].partition: i for i in range(t_first, t_last)}
+                t_diff_end = [target.diff_end[t_index[tp.partition]] if tp.partition in t_index else 0
+                              for tp in s_tps]
+            for tp, s_diff_end, t_diff_end in zip(s_tps, source.diff_end[s_first:s_last], t_diff_end):
+                self.metrics["partition_lag"][(t_name, tp.partition)] = s_diff_end - t_diff_end
+
+# Chooses topics for loop iteration: topics with lag or period diff in their last check are checked every
+# iteration, healthy ones every healthy_every iterations, least recently checked first. Topics which don't fit
+# to deadline by time of previous iterations (fixed time plus time per partition) are left for next iterations
+class Scheduler(object):
+    def __init__(self, healthy_every, deadline, lag_threshold):
+        self.healthy_every = healthy_every
+        self.deadline = deadline
+        self.lag_threshold = lag_threshold
+        self.started = time.time()
+        self.topics = []
+        # topic -> time of last check
+        self.checked = {}
+        self.lagging = set()
+        # Decaying sums of (1, partitions, duration, partitions^2, partitions*duration) of iterations,
+        # to fit duration = fixed time + time per partition * partitions
+        self.cost_sums = None
+        self.fixed_time = 0
+
+    # (fixed time, time per partition) or None if not known
+    def cost_model(self):
+        if self.cost_sums is None:
+            return None
+        w, n, d, nn, nd = self.cost_sums
+        mean_n, mean_d = n / w, d / w
+        var_n = nn / w - mean_n ** 2
+        if var_n > (0.05 * mean_n) ** 2:
+            per_partition = (nd / w - mean_n * mean_d) / var_n
+            self.fixed_time = min(max(mean_d - per_partition * mean_n, 0), mean_d)
+        else:
+            # Iterations of the same size, fixed time is known from earlier iterations if any
+            per_partition = (mean_d - self.fixed_time) / mean_n
+        if per_partition <= 0:
+            return None
+        return self.fixed_time, per_partition
+
+    # partitions is number of partitions of topics, topics not known count as one partition
+    def select(self, topics, partitions):
+        self.topics = topics
+        topics_set = set(topics)
+        self.checked = {topic: ts for topic, ts in self.checked.items() if topic in topics_set}
+        self.lagging &= self.checked.keys()
+
+        by_check = sorted(topics, key=lambda topic: self.checked.get(topic, 0))
+        lagging = [topic for topic in by_check if topic in self.lagging]
+        healthy = [topic for topic in by_check if topic not in self.lagging]
+        selected = lagging + healthy[:math.ceil(len(healthy) / self.healthy_every)]
+        model = self.cost_model()
+        if model:
+            fixed, per_partition = model
+            budget = self.deadline - fixed
+            if budget <= 0:
+                # Less topics don't make iteration shorter
+                logging.warning(f"fixed time of iteration {fixed:.1f}s is over deadline {self.deadline}s")
+                return selected
+            fit = 0
+            cost = 0
+            for topic in selected:
+                cost += partitions.get(topic, 1) * per_partition
+                if cost > budget and fit:
+                    break
+                fit += 1
+            if fit < len(selected):
+                logging.warning(f"only {fit} of {len(selected)} topics fit to iteration deadline {self.deadline}s")
+                selected = selected[:fit]
+        return selected
+
+    # partitions is number of partitions checked
+    def update(self, topics, metrics, duration, partitions):
+        now = time.time()
+        for topic in topics:
+            self.checked[topic] = now
+            if metrics["topic_lag"][topic] > self.lag_threshold or metrics["topic_period_diff"][topic] != 0:
+                self.lagging.add(topic)
+            else:
+                self.lagging.discard(topic)
+        if partitions:
+            sample = (1, partitions, duration, partitions ** 2, partitions * duration)
+            if self.cost_sums is None:
+                self.cost_sums = sample
+            else:
+                self.cost_sums = tuple(0.8 * s + x for s, x in zip(self.cost_sums, sample))
+
+    # Topics not checked yet count from start
+    def coverage_lag(self):
+        now = time.time()
+        return max((now - self.checked.get(topic, self.started) for topic in self.topics), default=0)
+
+# Collects metrics of topics of one shard
+class Monitor(object):
+    def __init__(self, conf, shard=0):
+        self.conf = conf
+        self.shard = shard
+        if isinstance(conf["topics"], list):
+            self.source_topics = Topics(conf["source"]["bservers"], conf["group_id"], topics=conf["topics"],
+                                        shard=shard, shards=conf["shards"])
+        else:
+            self.source_topics = Topics(conf["source"]["bservers"], conf["group_id"], topics_bl=conf["topics_bl"],
+                                        shard=shard, shards=conf["shards"])
+        self.topics_stats = TopicsStats(conf["source"], conf["target"],
+                                        conf["monitor_period"], conf["monitor_shift"],
+                                        conf["lag_threshold"], conf["group_id"],
+                                        metadata_ttl=conf["metadata_ttl"],
+                                        history_step=conf["history_step"],
+                                        history_file=self.history_file())
+        self.scheduler = Scheduler(conf["healthy_every"], self.deadline(), conf["lag_threshold"])
+        # topic -> (lag, period diff, {partition: lag}) of its last check
+        self.topic_metrics = {}
+
+    def deadline(self):
+        return self.conf["iter_deadline"] or self.conf["interval"]
+
+    # File of offsets history, one per shard
+    def history_file(self):
+        if not self.conf["history_file"] or self.conf["shards"] == 1:
+            return self.conf["history_file"]
+        return f"{self.conf['history_file']}.{self.shard}"
+
+    # One loop iteration, metrics is None if it failed
+    def iterate(self):
+        report = {
+            "shard": self.shard,
+            "iter_start": time.time(),
+            "topics": None,
+            "metrics": None
+        }
+        try:
+            topics = self.source_topics.get()
+            report["topics"] = len(topics)
+            selected = self.scheduler.select(topics, self.topics_stats.partition_counts())
+            report["topics_checked"] = len(selected)
+            collect_start = time.time()
+            metrics = self.topics_stats.collect(selected)
+            self.scheduler.update(selected, metrics, time.time() - collect_start,
+                                  self.topics_stats.partitions_checked())
+            report["metrics"] = self.merge_metrics(topics, selected, metrics)
+        except Exception as e:
+            logging.error(f"metrics collection failed, raised exception {e}")
+        report["cluster_durations"] = dict(self.topics_stats.cluster_durations)
+        report["coverage_lag"] = self.scheduler.coverage_lag()
+        report["iter_duration"] = time.time() - report["iter_start"]
+        report["iter_overrun"] = max(report["iter_duration"] - self.deadline(), 0)
+        return report
+
+    # Metrics of all topics, topics not checked in this iteration keep values of their last check
+    def merge_metrics(self, topics, selected, metrics):
+        partition_lag = {topic: {} for topic in selected}
+        for (topic, p), lag in metrics["partition_lag"].items():
+            partition_lag[topic][p] = lag
+        for topic in selected:
+            self.topic_metrics[topic] = (metrics["topic_lag"][topic], metrics["topic_period_diff"][topic],
+                                         partition_lag[topic])
+        self.topic_metrics = {topic: self.topic_metrics[topic] for topic in topics if topic in self.topic_metrics}
+
+        merged = {
+            "number_of_lag_topics": 0,
+            "number_of_period_diff_topics": 0,
+            "topic_lag": {},
+            "topic_period_diff": {},
+            "partition_lag": {}
+        }
+        for topic, (lag, period_diff, p_lags) in self.topic_metrics.items():
+            if lag > self.conf["lag_threshold"]:
+                merged["number_of_lag_topics"] += 1
+            if period_diff != 0:
+                merged["number_of_period_diff_topics"] += 1
+            merged["topic_lag"][topic] = lag
+            merged["topic_period_diff"][topic] = period_diff
+            for p, p_lag in p_lags.items():
+                merged["partition_lag"][(topic, p)] = p_lag
+        return merged
+
+    def close(self):
+        for client in [self.source_topics, self.topics_stats]:
+            try:
+                client.close()
+            except Exception as e:
+                logging.error(f"closing Kafka client failed: {e}")
+
+# Worker process of one shard, reports of iterations are sent to MainApp through the queue,
+# requests for debug output are answered through debug_conn between iterations
+def shard_worker(conf, shard, queue, debug_conn):
+    # MainApp handles signals and terminates workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=conf["log_level"], format=f"shard {shard}: " + conf["log_format"])
+    monitor = Monitor(conf, shard)
+    while True:
+        report = monitor.iterate()
+        queue.put(report)
+        # Iterations start every interval, the next one at once after overrun
+        next_iter = report["iter_start"] + conf["interval"]
+        while debug_conn.poll(max(next_iter - time.time(), 0)):
+            debug_conn.recv()
+            debug_conn.send(monitor.topics_stats.dump())
 
 class MainApp(object):
     DEFAULT_CONFIG = {
@@ -175,10 +698,20 @@ class MainApp(object):
         "watch_dog_diff": 600,
         "topics_bl": ["[-.]internal$", "^_", "\.replica$"],
         "monitor_period": 21600,
-        "monitor_shift": 10
+        "monitor_shift": 10,
+        "metadata_ttl": 300,
+        "history_step": 300,
+        "history_file": None,
+        "topic_metrics_top": 100,
+        "topic_metrics_threshold": 0,
+        "partition_metrics": False,
+        "healthy_every": 1,
+        "iter_deadline": None,
+        "shards": 1,
+        "shard": None
     }
 
-    def __init__(self, conf):
+    def __init__(self, conf, shard=None):
         self.conf = copy.copy(self.DEFAULT_CONFIG)
         try:
             with open(conf, "r") as config_f:
@@ -188,6 +721,8 @@ class MainApp(object):
             sys.exit(1)
 
         self.conf.update(conf_file)
+        if shard is not None:
+            self.conf["shard"] = shard
         # logging
         logging.basicConfig(level=self.conf["log_level"], format=self.conf["log_format"])
         logging.info("Started")
@@ -196,26 +731,45 @@ class MainApp(object):
         for sgn in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
             signal.signal(sgn, self.__signal_handler)
 
-        self.watch_dog = None
+        self.monitor = None
+        self.workers = {}
+        self.debug_conns = {}
+        if not (isinstance(self.conf["topics"], str) and self.conf["topics"] == "ALL" or
+                isinstance(self.conf["topics"], list)):
+            logging.fatal("No topics list defined")
+            self.shutdown(1)
+        if self.conf["shard"] is not None and not 0 <= self.conf["shard"] < self.conf["shards"]:
+            logging.fatal(f"shard {self.conf['shard']} is out of {self.conf['shards']} shards")
+            self.shutdown(1)
+        if self.conf["healthy_every"] < 1:
+            logging.fatal("healthy_every should be 1 or more")
+            self.shutdown(1)
+
+        # Shards monitored by this instance: one given shard, otherwise all of them,
+        # more than one in worker processes
+        if self.conf["shard"] is not None:
+            self.shards = [self.conf["shard"]]
+        else:
+            self.shards = list(range(self.conf["shards"]))
+        self.watch_dogs = {shard: int(time.time()) for shard in self.shards}
+        self.watch_dog = min(self.watch_dogs.values())
+
+        s_name = self.conf["source"]["name"]
+        self.topic_gauges = {}
+        for shard in self.shards:
+            self.topic_gauges[shard] = (LabeledGauge(TOPIC_LAG, s_name), LabeledGauge(TOPIC_PERIOD_DIFF, s_name),
+                                        LabeledGauge(PARTITION_LAG, s_name))
+
         # Run health check web handler in seperate thread
-        self.web = HTTPServer(("", self.conf["web_port"]), 
-                              self.web_class_creator())
+        # Metrics are rendered once per iteration, scrapes get the cached payload
+        self.metrics_payload = generate_latest()
+        self.web = ThreadingHTTPServer(("", self.conf["web_port"]), self.web_class_creator())
+        self.web.daemon_threads = True
         self.web_thread = threading.Thread(target = self.web.serve_forever, 
                                            daemon=True).start()
 
-        if isinstance(self.conf["topics"], str) and self.conf["topics"] == "ALL":
-            self.source_topics = Topics(self.conf["source"]["bservers"], 
-                                        self.conf["group_id"], topics_bl=self.conf["topics_bl"])
-        elif isinstance(self.conf["topics"], list):
-            self.source_topics = Topics(self.conf["source"]["bservers"], 
-                                        self.conf["group_id"], topics=self.conf["topics"])
-        else:
-            logging.fatal("No topics list defined")
-            self.shutdown(1)
-        
-        self.topics_stats = TopicsStats(self.conf["source"], self.conf["target"], 
-                                        self.conf["monitor_period"], self.conf["monitor_shift"],
-                                        self.conf["lag_threshold"], self.conf["group_id"])
+        if len(self.shards) == 1:
+            self.monitor = Monitor(self.conf, self.shards[0])
 
         self.main()
 
@@ -230,42 +784,137 @@ class MainApp(object):
 
     def main(self):
         s_name = self.conf["source"]["name"]
-        ITER_FAILED.labels(s_name).inc(0)
+        for shard in self.shards:
+            ITER_FAILED.labels(s_name, str(shard)).inc(0)
+        if self.monitor:
+            while True:
+                report = self.monitor.iterate()
+                self.report(report)
+                # Iterations start every interval, the next one at once after overrun
+                sleep = max(report["iter_start"] + self.conf["interval"] - time.time(), 0)
+                logging.info(f"Sleep for {sleep:.1f}s")
+                time.sleep(sleep)
+
+        # Worker process per shard
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        for shard in self.shards:
+            self.start_worker(context, shard, queue)
         while True:
-            iter_start = time.time()
-            ITER_START.labels(s_name).set(iter_start)
-            self.watch_dog = int(iter_start)
             try:
-                topics = self.source_topics.get()
-                TOPICS.labels(s_name).set(len(topics))
-                metrics = self.topics_stats.collect(topics)
-            except Exception as e:
-                logging.error(f"metrics collection failed, raised exception {e}")
-                ITER_FAILED.labels(s_name).inc()
-                ITER_LAST_STATUS.labels(s_name).set(0)
-                NUMBER_OF_PERIOD_DIFF_TOPICS.labels(s_name).set(-1)
-                NUMBER_OF_LAG_TOPICS.labels(s_name).set(-1)
-            else:
-                ITER_LAST_SUCCESS.labels(s_name).set(time.time())
-                ITER_LAST_STATUS.labels(s_name).set(1)
-                NUMBER_OF_PERIOD_DIFF_TOPICS.labels(s_name).set(metrics["number_of_period_diff_topics"])
-                NUMBER_OF_LAG_TOPICS.labels(s_name).set(metrics["number_of_lag_topics"])
-                logging.debug(metrics)
-            ITER_DURATION.labels(s_name).set(time.time() - iter_start)
-            logging.info(f"Sleep for {self.conf['interval']}s")
-            time.sleep(self.conf["interval"])
+                self.report(queue.get(timeout=self.conf["interval"]))
+            except Empty:
+                pass
+            for shard, worker in self.workers.items():
+                if not worker.is_alive():
+                    logging.error(f"worker of shard {shard} exited with code {worker.exitcode}, restarting")
+                    self.start_worker(context, shard, queue)
+
+    def start_worker(self, context, shard, queue):
+        debug_conn, worker_conn = context.Pipe()
+        self.debug_conns[shard] = (debug_conn, threading.Lock())
+        self.workers[shard] = context.Process(target=shard_worker, args=(self.conf, shard, queue, worker_conn),
+                                              daemon=True)
+        self.workers[shard].start()
+
+    # Offsets of last iteration of shard, from worker process it's got when the worker waits for next iteration
+    def debug_result(self, shard):
+        if self.monitor:
+            return self.monitor.topics_stats.dump()
+        debug_conn, lock = self.debug_conns[shard]
+        with lock:
+            # Answer to request which timed out before
+            while debug_conn.poll():
+                debug_conn.recv()
+            debug_conn.send(None)
+            if not debug_conn.poll(self.conf["watch_dog_diff"]):
+                raise TimeoutError(f"worker of shard {shard} didn't answer")
+            return debug_conn.recv()
+
+    # Sets metrics from report of shard's iteration
+    def report(self, report):
+        s_name = self.conf["source"]["name"]
+        shard = str(report["shard"])
+        self.watch_dogs[report["shard"]] = int(report["iter_start"])
+        self.watch_dog = min(self.watch_dogs.values())
+        ITER_START.labels(s_name, shard).set(report["iter_start"])
+        if report["topics"] is not None:
+            TOPICS.labels(s_name, shard).set(report["topics"])
+        if "topics_checked" in report:
+            TOPICS_CHECKED.labels(s_name, shard).set(report["topics_checked"])
+        COVERAGE_LAG.labels(s_name, shard).set(report["coverage_lag"])
+        ITER_OVERRUN.labels(s_name, shard).set(report["iter_overrun"])
+        for cl_name, duration in report["cluster_durations"].items():
+            CLUSTER_COLLECT_DURATION.labels(s_name, shard, cl_name).set(duration)
+        metrics = report["metrics"]
+        if metrics is None:
+            ITER_FAILED.labels(s_name, shard).inc()
+            ITER_LAST_STATUS.labels(s_name, shard).set(0)
+            NUMBER_OF_PERIOD_DIFF_TOPICS.labels(s_name, shard).set(-1)
+            NUMBER_OF_LAG_TOPICS.labels(s_name, shard).set(-1)
+        else:
+            ITER_LAST_SUCCESS.labels(s_name, shard).set(report["iter_start"] + report["iter_duration"])
+            ITER_LAST_STATUS.labels(s_name, shard).set(1)
+            NUMBER_OF_PERIOD_DIFF_TOPICS.labels(s_name, shard).set(metrics["number_of_period_diff_topics"])
+            NUMBER_OF_LAG_TOPICS.labels(s_name, shard).set(metrics["number_of_lag_topics"])
+            self.set_topic_metrics(metrics, *self.topic_gauges[report["shard"]])
+            logging.debug(f"shard {shard} lag topics: {metrics['number_of_lag_topics']}, "
+                          f"period diff topics: {metrics['number_of_period_diff_topics']}")
+        ITER_DURATION.labels(s_name, shard).set(report["iter_duration"])
+        self.metrics_payload = generate_latest()
+
+    # Number of exported topics is limited by topic_metrics_top and topic_metrics_threshold
+    def set_topic_metrics(self, metrics, topic_lag, topic_period_diff, partition_lag):
+        top = self.conf["topic_metrics_top"]
+        threshold = self.conf["topic_metrics_threshold"]
+        lag_topics = select_top(metrics["topic_lag"], top, threshold)
+        topic_lag.set({(topic,): lag for topic, lag in lag_topics.items()})
+        topic_period_diff.set({(topic,): diff for topic, diff in
+                               select_top(metrics["topic_period_diff"], top, threshold).items()})
+        if self.conf["partition_metrics"]:
+            partition_lag.set({(topic, str(p)): lag for (topic, p), lag in metrics["partition_lag"].items()
+                               if topic in lag_topics})
 
     def web_class_creator(self):
-        class WebHandler(MetricsHandler):
+        class WebHandler(BaseHTTPRequestHandler):
             _main = self
+            # Stuck clients are dropped instead of holding their thread
+            timeout = 10
             def do_GET(self_):
                 if self_.path in ["/healthcheck", "/status", "/health"]:
                     self_.handle_health_check()
                 elif self_.path == "/metrics":
-                    logging.debug("Metrics triggered")
-                    super().do_GET()
+                    self_.handle_metrics()
+                elif urlparse(self_.path).path == "/debug":
+                    self_.handle_debug()
                 else:
                     self_.not_implemented()
+            def handle_metrics(self_):
+                logging.debug("Metrics triggered")
+                payload = self_._main.metrics_payload
+                self_.send_response(200)
+                self_.send_header("Content-Type", CONTENT_TYPE_LATEST)
+                self_.send_header("Content-Length", str(len(payload)))
+                self_.end_headers()
+                self_.wfile.write(payload)
+            # JSON dump of offsets of last iteration, /debug?shard=N for other than first shard
+            def handle_debug(self_):
+                logging.debug("Debug triggered")
+                query = parse_qs(urlparse(self_.path).query)
+                try:
+                    shard = int(query["shard"][0]) if "shard" in query else self_._main.shards[0]
+                    if shard not in self_._main.shards:
+                        raise ValueError(f"shard {shard} is not monitored by this instance")
+                    body = json.dumps(self_._main.debug_result(shard), sort_keys=True, indent=4)
+                    self_.send_response(200)
+                    self_.send_header("Content-Type", "application/json")
+                except Exception as e:
+                    body = f"FAILED: {e}"
+                    self_.send_response(500)
+                    self_.send_header("Content-Type", "text/plain; charset=utf-8")
+                self_.end_headers()
+                self_.wfile.write(body.encode("utf-8"))
+
             def handle_health_check(self_):
                 logging.debug("Health check triggered")
                 cur_ts = int(time.time())
@@ -289,10 +938,17 @@ class MainApp(object):
                 self_.end_headers()
                 self_.wfile.write("NOT IMPLEMENTED".encode("utf-8"))
 
+            def log_message(self_, format, *args):
+                pass
+
         return WebHandler
 
     def shutdown(self, exit_code=0):
         logging.info("Exit")
+        if self.monitor:
+            self.monitor.close()
+        for worker in self.workers.values():
+            worker.terminate()
         exit(exit_code)
 
 if __name__ == "__main__":   
@@ -301,4 +957,4 @@ if __name__ == "__main__":
         print(f"FATAL: config file doesn't exist {args.config}")
         sys.exit(1)
     else:
-        MainApp(conf=args.config)
\ No newline at end of file
+        MainApp(conf=args.config, shard=args.shard)
\ No newline at end of file